@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import math
+import os
+import resource
+import sys
+import time
+from include.engine import Engine, CONCURRENCY, PER_HOST_CONCURRENCY, P2P_CONCURRENCY
+from include.fleet import MockFleet, HANG
+from include.pool import HttpPool
+from include.cache import HttpCache
+from include.producers import ProducerFetcher
+from include.canonical import HashCache
+from include.ratelimit import RateLimiter, RATE, BURST
+from include.retry import RetryPolicy
+from include.breaker import CircuitBreaker
+from include.dns import Resolver
+from include.document import DocumentFetcher
+
+parser = argparse.ArgumentParser(
+    description="Time sweeps of a local mock fleet of producers"
+)
+parser.add_argument("-n", "--producers", type=int, default=100, help="Producers")
+parser.add_argument("--sweeps", type=int, default=5, help="Sweeps to time")
+parser.add_argument("--warmup", type=int, default=1, help="Sweeps run first, untimed")
+parser.add_argument(
+    "--latency", type=float, default=0.0, help="Seconds every producer request takes"
+)
+parser.add_argument(
+    "--error-rate", type=float, default=0.0, help="Share of requests answered 500"
+)
+parser.add_argument(
+    "--timeout-rate",
+    type=float,
+    default=0.0,
+    help="Share of requests hanging for --hang seconds",
+)
+parser.add_argument("--hang", type=float, default=HANG, help="Seconds a hang lasts")
+parser.add_argument("--timeout", type=float, default=2, help="Request timeout")
+parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+parser.add_argument("--per-host", type=int, default=PER_HOST_CONCURRENCY)
+parser.add_argument("--p2p-concurrency", type=int, default=P2P_CONCURRENCY)
+parser.add_argument(
+    "--rate", type=float, default=RATE, help="Requests per second per host"
+)
+parser.add_argument("--burst", type=int, default=BURST)
+parser.add_argument(
+    "--cold",
+    action="store_true",
+    help="Start every sweep with empty caches, as a fresh process would",
+)
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+parser.add_argument(
+    "-v", "--verbose", action="store_true", help="Print logged info to screen"
+)
+
+
+def shared_state(args):
+    """The objects nodestatus.py shares between chains, in memory only"""
+    resolver = Resolver()
+    http = HttpPool(resolver=resolver)
+    documents = DocumentFetcher()
+    return {
+        "resolver": resolver,
+        "http": http,
+        "documents": documents,
+        "cache": HttpCache(http, documents=documents),
+        "hashes": HashCache(),
+        "breaker": CircuitBreaker(http=http),
+        # Asked every sweep, as every sweep of nodestatus.py does
+        "fetcher": ProducerFetcher(log, http, ttl=0),
+    }
+
+
+def chain_engine(chain_info, args, shared):
+    return Engine(
+        chain_info,
+        log,
+        concurrency=args.concurrency,
+        per_host=args.per_host,
+        p2p_concurrency=args.p2p_concurrency,
+        http=shared["http"],
+        cache=shared["cache"],
+        hashes=shared["hashes"],
+        limiter=RateLimiter(rate=args.rate, burst=args.burst),
+        policy=RetryPolicy(),
+        breaker=shared["breaker"],
+        resolver=shared["resolver"],
+        documents=shared["documents"],
+    )
+
+
+async def sweep(chain_info, args, shared):
+    """get_producers and every producer's checks; returns the checkers"""
+    producers = await asyncio.to_thread(shared["fetcher"].get, chain_info)
+    engine = chain_engine(chain_info, args, shared)
+    return await engine.run_async(producers)
+
+
+def percentile(values, q):
+    """Nearest-rank q-th quantile of values"""
+    values = sorted(values)
+    return values[max(math.ceil(q * len(values)) - 1, 0)]
+
+
+def peak_rss():
+    """Peak resident set size of this process, in bytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run(args):
+    fleet = MockFleet(
+        producers=args.producers,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        timeout_rate=args.timeout_rate,
+        hang=args.hang,
+        seed=args.seed,
+    )
+    with fleet:
+        chain_info = fleet.chain_info(timeout=args.timeout)
+        shared = shared_state(args)
+        times = []
+        for num in range(args.warmup + args.sweeps):
+            if args.cold:
+                shared = shared_state(args)
+            # Checker prints some of what it finds
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                started = time.monotonic()
+                checkers = asyncio.run(sweep(chain_info, args, shared))
+                elapsed = time.monotonic() - started
+            if num >= args.warmup:
+                times.append(elapsed)
+            log.info("Sweep {} took {:.3f}s".format(num + 1, elapsed))
+
+    requests = shared["http"].stats()["requests"]
+    return {
+        "producers": args.producers,
+        "sweeps": len(times),
+        "sweeps_per_second": round(len(times) / sum(times), 3) if times else None,
+        "p50_seconds": round(percentile(times, 0.5), 3) if times else None,
+        "p99_seconds": round(percentile(times, 0.99), 3) if times else None,
+        "requests_per_sweep": round(requests / (1 if args.cold else num + 1)),
+        "healthy_api_endpoints": sum(len(c.healthy_api_endpoints) for c in checkers),
+        "peak_rss_mb": round(peak_rss() / 1024 / 1024, 1),
+    }
+
+
+def main():
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, sort_keys=True))
+        return
+    print(
+        "{producers} producers, {sweeps} sweeps: {sweeps_per_second} sweeps/s, "
+        "p50 {p50_seconds}s, p99 {p99_seconds}s, {requests_per_sweep} requests "
+        "per sweep, {healthy_api_endpoints} healthy API endpoints, peak RSS "
+        "{peak_rss_mb} MB".format(**report)
+    )
+
+
+args = parser.parse_args()
+log = logging.getLogger("benchmark")
+log.propagate = False
+if args.verbose:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+else:
+    log.addHandler(logging.NullHandler())
+
+if __name__ == "__main__":
+    main()
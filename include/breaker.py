@@ -0,0 +1,207 @@
+import datetime
+import json
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+from include.checker import ProbeResult
+from include.pool import HttpPool
+
+THRESHOLD = 5
+INTERVAL = 600
+MAX_INTERVAL = 24 * 3600
+
+
+def address_of(url):
+    """(host, port) a TCP connect to the endpoint goes to"""
+    if "://" not in url:
+        host, port = url.rsplit(":", 1)
+        return host, int(port)
+    parsed = urlparse(url)
+    return parsed.hostname, parsed.port or (443 if parsed.scheme == "https" else 80)
+
+
+class CircuitBreaker:
+    """Stops probing endpoints that have been dead for a while
+
+    A probe fails when it reports errors and nothing ok, and succeeds when
+    it reports anything ok. Failures are counted per endpoint and probe
+    kind, so one failing feature doesn't count against the others. After
+    threshold failed probes of a kind in a row, an endpoint that also
+    fails the cheap probe, a HEAD request or for p2p endpoints a TCP
+    connect, is opened: its probes are no longer run and their last
+    results are reported again, with a note saying since when the
+    endpoint is unreachable. Kinds without a last result are still run.
+    Every interval seconds, doubling up to max_interval while it stays
+    dead, the cheap probe is tried; once it succeeds the breaker closes
+    and the endpoint is probed as usual.
+
+    Only endpoints with failures are tracked, in a JSON file kept between
+    runs.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        threshold=THRESHOLD,
+        interval=INTERVAL,
+        max_interval=MAX_INTERVAL,
+        http=None,
+    ):
+        self.path = path
+        self.http = http or HttpPool()
+        self.threshold = threshold
+        self.interval = interval
+        self.max_interval = max_interval
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.changed = False
+        self.skipped = 0
+        if path:
+            try:
+                with open(path, "r") as fp:
+                    self.endpoints = json.load(fp)
+            except (OSError, ValueError):
+                pass
+        for entry in self.endpoints.values():
+            if not isinstance(entry["failures"], dict):
+                # Counted per endpoint by older versions
+                entry["failures"] = {kind: 1 for kind in entry["results"]}
+
+    @classmethod
+    def from_config(cls, CONFIG, base_path, http):
+        settings = CONFIG.get("breaker", {})
+        path = settings.get("path", "breaker.json")
+        return cls(
+            path=path and os.path.join(base_path, path),
+            threshold=settings.get("threshold", THRESHOLD),
+            interval=settings.get("interval", INTERVAL),
+            max_interval=settings.get("max_interval", MAX_INTERVAL),
+            http=http,
+        )
+
+    def reachable(self, url, timeout):
+        """Whether the endpoint answers at all"""
+        try:
+            if "://" in url:
+                self.http.request("HEAD", url, timeout=timeout, allow_redirects=False)
+            else:
+                socket.create_connection(address_of(url), timeout=timeout).close()
+            return True
+        except Exception:
+            return False
+
+    def guard(self, kind, url, run, timeout):
+        """run(kind, url) unless the endpoint's breaker is open; returns the
+        probe's result or the last one recorded"""
+        replay = self.admit(kind, url, timeout)
+        if replay is not None:
+            return replay
+        result = run(kind, url)
+        self.record(kind, url, result, timeout)
+        return result
+
+    def admit(self, kind, url, timeout):
+        """None if the probe may run, else the result to report instead;
+        callers that run the probe themselves record its result"""
+        with self.lock:
+            entry = self.endpoints.get(url)
+            is_open = entry is not None and entry.get("open")
+            # A kind with nothing to report instead is probed as usual
+            is_open = is_open and kind in entry["results"]
+            if is_open and time.time() < entry["next_check"]:
+                self.skipped += 1
+                return self.replay(kind, url, entry)
+
+        if is_open:
+            if not self.reachable(url, timeout):
+                with self.lock:
+                    entry["interval"] = min(entry["interval"] * 2, self.max_interval)
+                    entry["next_check"] = time.time() + entry["interval"]
+                    self.changed = True
+                    self.skipped += 1
+                    return self.replay(kind, url, entry)
+            with self.lock:
+                self.endpoints.pop(url, None)
+                self.changed = True
+        return None
+
+    def record(self, kind, url, result, timeout):
+        with self.lock:
+            entry = self.endpoints.get(url)
+            if result.oks:
+                if entry is None:
+                    return
+                # It answers; its other kinds keep their failures
+                entry.pop("open", None)
+                entry["failures"].pop(kind, None)
+                entry["results"].pop(kind, None)
+                if not entry["failures"]:
+                    del self.endpoints[url]
+                self.changed = True
+                return
+            if not result.errors and entry is None:
+                # Some probes only log; they say nothing about the endpoint
+                return
+            self.changed = True
+            if entry is None:
+                entry = self.endpoints[url] = {
+                    "failures": {},
+                    "since": time.time(),
+                    "results": {},
+                }
+            entry["results"][kind] = {
+                "errors": result.errors,
+                "oks": result.oks,
+                "status": result.status,
+                "wrong_chain_id": result.wrong_chain_id,
+            }
+            if not result.errors:
+                return
+            failures = entry["failures"][kind] = entry["failures"].get(kind, 0) + 1
+            if failures < self.threshold or entry.get("open"):
+                return
+
+        if not self.reachable(url, timeout):
+            with self.lock:
+                entry["open"] = True
+                entry["interval"] = self.interval
+                entry["next_check"] = time.time() + self.interval
+
+    def replay(self, kind, url, entry):
+        last = entry["results"].get(kind)
+        if last is None:
+            return None
+        since = datetime.datetime.utcfromtimestamp(entry["since"])
+        note = "Not probed, {} unreachable since {}".format(
+            url, since.strftime("%Y-%m-%d %H:%M UTC")
+        )
+        return ProbeResult(
+            kind,
+            url,
+            errors=last["errors"] + [note],
+            oks=last["oks"],
+            healthy=False,
+            status=last["status"],
+            wrong_chain_id=last["wrong_chain_id"],
+        )
+
+    def stats(self):
+        with self.lock:
+            return {
+                "open": sum(1 for e in self.endpoints.values() if e.get("open")),
+                "failing": len(self.endpoints),
+                "skipped": self.skipped,
+            }
+
+    def save(self):
+        with self.lock:
+            if not self.path or not self.changed:
+                return
+            self.changed = False
+            data = json.dumps(self.endpoints)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fp:
+            fp.write(data)
+        os.replace(tmp, self.path)
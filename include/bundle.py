@@ -0,0 +1,106 @@
+import glob
+import json
+from include.output import dumps, write_file
+
+NUM_DAYS = 45
+DATE_GLOB = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"
+
+
+class Bundle:
+    """pub/<chain_id>-bundle.json, the last NUM_DAYS daily snapshots of a
+    chain keyed by date, maintained incrementally
+
+    A sidecar pub/<chain_id>-bundle.index.json records where each date's
+    value sits in the bundle file. Adding a day copies the retained days'
+    bytes from the previous bundle as they are and serializes only the new
+    day, producing the same file serializing the whole bundle with indent=2
+    would. The publisher, if any, serializes and writes compressed copies.
+    Without a usable index the bundle is rebuilt once from the history
+    store, and from the daily files for days the store doesn't have.
+    """
+
+    def __init__(
+        self, pub_path, chain_id, num_days=NUM_DAYS, history=None, publisher=None
+    ):
+        self.pub_path = pub_path
+        self.chain_id = chain_id
+        self.num_days = num_days
+        self.history = history
+        self.publisher = publisher
+        self.dumps = publisher.dumps if publisher else dumps
+        self.path = f"{pub_path}/{chain_id}-bundle.json"
+        self.index_path = f"{pub_path}/{chain_id}-bundle.index.json"
+
+    def update(self, date, data):
+        fragments = self.load()
+        if fragments is None:
+            fragments = self.rebuild()
+        fragments[date] = fragment(data, self.dumps)
+        self.write(fragments)
+
+    def load(self):
+        """Serialized value of every date in the current bundle, None if the
+        bundle and its index don't agree"""
+        try:
+            with open(self.index_path, "r") as fp:
+                index = json.load(fp)
+            with open(self.path, "rb") as fp:
+                content = fp.read()
+        except (OSError, ValueError):
+            return None
+        if index.get("size") != len(content):
+            return None
+        return {
+            date: content[offset : offset + length]
+            for date, (offset, length) in index["dates"].items()
+        }
+
+    def rebuild(self):
+        files = {
+            file[-15:-5]: file
+            for file in glob.glob(f"{self.pub_path}/{self.chain_id}-{DATE_GLOB}.json")
+        }
+        stored = self.history.dates(self.chain_id) if self.history else []
+        dates = sorted(set(files) | set(stored))[-self.num_days :]
+        if not dates:
+            return {}
+
+        fragments = {}
+        if self.history:
+            snapshots = self.history.query(self.chain_id, dates[0], dates[-1])
+            for date, data in snapshots.items():
+                fragments[date] = fragment(data, self.dumps)
+        for date in dates:
+            if date not in fragments:
+                with open(files[date], "r") as fp:
+                    fragments[date] = fragment(json.load(fp), self.dumps)
+        return fragments
+
+    def write(self, fragments):
+        dates = sorted(fragments)[-self.num_days :]
+        parts = [b"{"]
+        offset = 1
+        index = {}
+        for num, date in enumerate(dates):
+            key = '{}\n  "{}": '.format("," if num else "", date).encode()
+            offset += len(key)
+            index[date] = [offset, len(fragments[date])]
+            offset += len(fragments[date])
+            parts += [key, fragments[date]]
+        parts.append(b"\n}" if dates else b"}")
+        content = b"".join(parts)
+
+        fsync = self.publisher.fsync if self.publisher else True
+        write_file(self.path, content, fsync)
+        if self.publisher:
+            self.publisher.compressed(self.path, content)
+        write_file(
+            self.index_path,
+            json.dumps({"size": len(content), "dates": index}).encode(),
+            fsync,
+        )
+
+
+def fragment(data, dumps=dumps):
+    """data serialized as a value one level deep in an indent=2 document"""
+    return dumps(data, 2).replace(b"\n", b"\n  ")
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from include.document import Document, DocumentFetcher
+
+TTL = 7 * 24 * 3600
+MAX_BYTES = 64 * 1024 * 1024
+
+
+class HttpCache:
+    """Conditional-GET cache for the JSON documents producers publish
+
+    Entries are keyed by URL and hold the body, ETag, Last-Modified and,
+    once parsed, the document. They are kept in memory and under path on
+    disk, so cron runs share them. Requests for a cached URL carry
+    If-None-Match/If-Modified-Since and a 304 reuses the stored document.
+    Entries not validated for ttl seconds expire, and the least recently
+    used ones are evicted once the bodies add up to more than max_bytes.
+    Documents are fetched through documents, see DocumentFetcher.
+    """
+
+    def __init__(self, http, path=None, ttl=TTL, max_bytes=MAX_BYTES, documents=None):
+        self.http = http
+        self.documents = documents or DocumentFetcher()
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self.load()
+
+    @classmethod
+    def from_config(cls, CONFIG, http, base_path, documents=None):
+        settings = CONFIG.get("cache", {})
+        path = settings.get("path", "cache")
+        return cls(
+            http,
+            path=path and os.path.join(base_path, path),
+            ttl=settings.get("ttl", TTL),
+            max_bytes=settings.get("max_bytes", MAX_BYTES),
+            documents=documents,
+        )
+
+    def load(self):
+        """Index the entries on disk, least recently used first"""
+        files = []
+        for item in os.scandir(self.path):
+            if item.name.endswith(".json"):
+                stat = item.stat()
+                files.append((stat.st_mtime, item.name[:-5], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = {"size": size}
+            self.size += size
+
+    def get(self, url, headers=None, timeout=None, http=None):
+        key = hashlib.sha1(url.encode()).hexdigest()
+        entry = self.lookup(key)
+        headers = dict(headers or {})
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = self.documents.fetch(
+            http or self.http, url, headers=headers, timeout=timeout, keep_text=True
+        )
+
+        if response.status_code == 304 and entry:
+            with self.lock:
+                self.hits += 1
+            if "response" not in entry:
+                entry["response"] = Document(200, entry["body"])
+            self.touch(key, entry)
+            return entry["response"]
+        with self.lock:
+            self.misses += 1
+        if response.status_code != 200:
+            return response
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        # Only kept to store it; the parsed document is what readers use
+        body, response.text = response.text, None
+        if etag or last_modified:
+            entry = {
+                "url": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "body": body,
+                # Shares the parsed document with every later 304
+                "response": response,
+            }
+            self.store(key, entry)
+        return response
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if "body" not in entry:
+            try:
+                with open(self.file(key), "r") as fp:
+                    entry.update(json.load(fp))
+            except Exception:
+                self.evict(key)
+                return None
+        if time.time() - entry["validated"] > self.ttl:
+            self.evict(key)
+            return None
+        return entry
+
+    def store(self, key, entry):
+        entry["size"] = self.write(key, entry)
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous:
+                self.size -= previous["size"]
+            self.entries[key] = entry
+            self.size += entry["size"]
+        self.shrink()
+
+    def touch(self, key, entry):
+        self.write(key, entry)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+
+    def write(self, key, entry):
+        """Mark the entry validated now and persist it; returns its size"""
+        entry["validated"] = time.time()
+        if not self.path:
+            return len(entry["body"])
+        data = json.dumps(
+            {k: v for k, v in entry.items() if k not in ("response", "size")}
+        )
+        tmp = "{}.{}.tmp".format(self.file(key), threading.get_ident())
+        with open(tmp, "w") as fp:
+            fp.write(data)
+        os.replace(tmp, self.file(key))
+        return len(data)
+
+    def evict(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.size -= entry["size"]
+        if self.path:
+            try:
+                os.remove(self.file(key))
+            except FileNotFoundError:
+                pass
+
+    def shrink(self):
+        while True:
+            with self.lock:
+                if self.size <= self.max_bytes or len(self.entries) <= 1:
+                    return
+                key = next(iter(self.entries))
+            self.evict(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
+
+    def file(self, key):
+        return os.path.join(self.path, key + ".json")
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+DIFF_LIMIT = 20
+VALUE_LIMIT = 80
+MAX_ENTRIES = 4096
+
+
+def canonical(document):
+    """document as compact JSON with sorted keys, the same bytes for any
+    two documents that parse to equal values"""
+    return json.dumps(
+        document, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    ).encode()
+
+
+def canonical_hash(text):
+    """sha256 of the canonical form of a JSON text, None if it doesn't parse"""
+    try:
+        document = json.loads(text)
+    except (TypeError, ValueError):
+        return None
+    return document_hash(document)
+
+
+def document_hash(document):
+    """sha256 of the canonical form of a parsed document"""
+    return hashlib.sha256(canonical(document)).hexdigest()
+
+
+def diff(old, new, limit=DIFF_LIMIT):
+    """At most limit differences between two parsed documents, as
+    "root['nodes'][0]['api_endpoint']: 'a' != 'b'" lines"""
+    changes = []
+    walk(old, new, "root", changes, limit)
+    return changes
+
+
+def walk(old, new, path, changes, limit):
+    if len(changes) >= limit:
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in sorted(set(old) | set(new), key=str):
+            item = "{}[{!r}]".format(path, key)
+            if key not in new:
+                changes.append("{}: removed".format(item))
+            elif key not in old:
+                changes.append("{}: added".format(item))
+            else:
+                walk(old[key], new[key], item, changes, limit)
+            if len(changes) >= limit:
+                return
+    elif isinstance(old, list) and isinstance(new, list):
+        for index in range(max(len(old), len(new))):
+            item = "{}[{}]".format(path, index)
+            if index >= len(new):
+                changes.append("{}: removed".format(item))
+            elif index >= len(old):
+                changes.append("{}: added".format(item))
+            else:
+                walk(old[index], new[index], item, changes, limit)
+            if len(changes) >= limit:
+                return
+    elif type(old) is not type(new) or old != new:
+        changes.append("{}: {} != {}".format(path, short(repr(old)), short(repr(new))))
+
+
+def short(text):
+    return text if len(text) <= VALUE_LIMIT else text[: VALUE_LIMIT - 2] + ".."
+
+
+class HashCache:
+    """Canonical hash of each JSON text seen, keyed by the sha256 of the raw
+    text, kept in a JSON file between runs
+
+    Texts that come back byte for byte the same, like an unchanged on-chain
+    producerjson record, are neither parsed nor canonicalized again. The
+    least recently used entries beyond max_entries are dropped.
+    """
+
+    def __init__(self, path=None, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.changed = False
+        if path:
+            try:
+                with open(path, "r") as fp:
+                    self.entries.update(json.load(fp))
+            except (OSError, ValueError):
+                pass
+
+    @classmethod
+    def from_config(cls, CONFIG, base_path):
+        path = CONFIG.get("cache", {}).get("hashes", "hashes.json")
+        return cls(path and os.path.join(base_path, path))
+
+    def get(self, text):
+        """Canonical hash of text, None if it isn't valid JSON"""
+        key = hashlib.sha256(text.encode()).hexdigest()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        value = canonical_hash(text)
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.changed = True
+        return value
+
+    def save(self):
+        with self.lock:
+            if not self.path or not self.changed:
+                return
+            self.changed = False
+            data = json.dumps(self.entries)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fp:
+            fp.write(data)
+        os.replace(tmp, self.path)
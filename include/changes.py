@@ -0,0 +1,236 @@
+import json
+import threading
+from collections import deque
+from include.canonical import document_hash
+from include.output import dumps, write_file
+
+MAX_ENTRIES = 1000
+# Change on every sweep without anything about the producers changing
+VOLATILE = ("last_update", "last_update_iso", "latency", "fastest_api_endpoints", "seq")
+ENDPOINT_FIELDS = ("endpoint_errors", "endpoint_ok_counts")
+# Published apart, left out of the summary
+DROPPED = ("latency",)
+# Lists whose order means nothing
+UNORDERED = ("endpoints",)
+
+
+class ChangeFeed:
+    """pub/<chain_id>-changes.jsonl, what changed between the sweeps of a
+    chain, and pub/<chain_id>-summary.json, a few kilobytes on how it is
+
+    The summary keeps each producer's status, errors and warnings, its
+    bp_json_hash for the bp.json content, and how many ok messages it got
+    overall and per endpoint; for the chain, how many endpoints of each
+    feature are healthy. It carries the seq of the last change. Each line
+    of the feed is one sweep's changes against the previous one:
+
+        {"seq": 12, "last_update_iso": "...",
+         "producers": {"<account>": {"<field>": <new value>,
+                                     "endpoint_errors": {"<url>": [...]},
+                                     "endpoint_ok_counts": {"<url>": 2}}},
+         "healthy_api_endpoints": {"added": [...], "removed": [...]}}
+
+    null stands for a producer or endpoint no longer there, and a new
+    producer comes whole. A line with "reset" means there was nothing to
+    compare with, so the chain's file is to be read. Sweeps that change
+    nothing add no line, and the feed keeps the last max_entries lines.
+    What is compared, see comparable(), is kept in memory, and made from
+    the chain's file in pub/ by the first sweep of a run.
+    """
+
+    def __init__(self, pub_path, chain_id, max_entries=MAX_ENTRIES, publisher=None):
+        self.path = f"{pub_path}/{chain_id}-changes.jsonl"
+        self.summary_path = f"{pub_path}/{chain_id}-summary.json"
+        self.data_path = f"{pub_path}/{chain_id}.json"
+        self.max_entries = max_entries
+        self.publisher = publisher
+        self.dumps = publisher.dumps if publisher else dumps
+        self.lock = threading.Lock()
+        self.state = None
+        self.summary = None
+        self.lines = None
+        self.seq = 0
+
+    @classmethod
+    def from_config(cls, CONFIG, pub_path, chain_id, publisher=None):
+        settings = CONFIG.get("changes", {})
+        return cls(
+            pub_path,
+            chain_id,
+            max_entries=settings.get("max_entries", MAX_ENTRIES),
+            publisher=publisher,
+        )
+
+    def load(self):
+        """The feed and summary the last run left in pub/"""
+        self.lines = deque(maxlen=self.max_entries)
+        try:
+            with open(self.path, "rb") as fp:
+                self.lines.extend(line for line in fp.read().splitlines() if line)
+        except OSError:
+            pass
+        try:
+            with open(self.summary_path, "r") as fp:
+                self.summary = json.load(fp)
+        except (OSError, ValueError):
+            self.summary = None
+        try:
+            with open(self.data_path, "r") as fp:
+                self.state = comparable(json.load(fp))
+        except (OSError, ValueError, KeyError):
+            self.state = None
+        seqs = [self.summary.get("seq", 0)] if self.summary else []
+        if self.lines:
+            try:
+                seqs.append(json.loads(self.lines[-1])["seq"])
+            except (ValueError, KeyError):
+                pass
+        self.seq = max(seqs, default=0)
+
+    def update(self, data):
+        """Record the changes in data since the previous sweep; returns the
+        new feed entry, None when nothing changed. Call it before data is
+        published, and write() once it is."""
+        with self.lock:
+            if self.lines is None:
+                self.load()
+            state = comparable(data)
+            if self.state is None:
+                changes = {"reset": True}
+            else:
+                changes = diff(self.state, state)
+            self.state = state
+            summary = self.summary = brief(state)
+            if not changes:
+                summary["seq"] = self.seq
+                return None
+            self.seq += 1
+            summary["seq"] = self.seq
+            entry = {
+                "seq": self.seq,
+                "last_update_iso": data.get("last_update_iso"),
+                **changes,
+            }
+            self.lines.append(self.dumps(entry))
+            return entry
+
+    def write(self):
+        with self.lock:
+            content = b"".join(line + b"\n" for line in self.lines)
+            summary = self.summary
+        fsync = self.publisher.fsync if self.publisher else True
+        write_file(self.path, content, fsync)
+        if self.publisher:
+            self.publisher.publish(summary, self.summary_path)
+        else:
+            write_file(self.summary_path, dumps(summary, 2), fsync)
+
+
+def summarize(data):
+    """The summary of data, see ChangeFeed"""
+    return brief(comparable(data))
+
+
+def brief(state):
+    """The summary of a comparable() state: its healthy lists counted, and
+    only the endpoints with errors listed"""
+    summary = {
+        key: value
+        for key, value in state.items()
+        if not key.startswith("healthy_") and key != "fastest_api_endpoints"
+    }
+    summary["healthy_counts"] = {
+        key[len("healthy_") : -len("_endpoints")]: len(value)
+        for key, value in state.items()
+        if key.startswith("healthy_")
+    }
+    summary["producers"] = []
+    for producer in state["producers"]:
+        producer = {key: value for key, value in producer.items() if key != "endpoints"}
+        if producer.get("endpoint_errors"):
+            producer["endpoint_errors"] = {
+                url: errors
+                for url, errors in producer["endpoint_errors"].items()
+                if errors
+            }
+        summary["producers"].append(producer)
+    return summary
+
+
+def comparable(data):
+    """data without bp.json contents and ok messages, which are counted"""
+    summary = {
+        key: value
+        for key, value in data.items()
+        if key != "producers" and key not in DROPPED
+    }
+    summary["producers"] = []
+    for producer in data["producers"]:
+        producer = dict(producer)
+        content = producer.pop("bp_json_content", None)
+        producer["bp_json_hash"] = None if content is None else document_hash(content)
+        if "oks" in producer:
+            producer["ok_count"] = len(producer.pop("oks") or [])
+        if "endpoint_oks" in producer:
+            producer["endpoint_ok_counts"] = {
+                url: len(oks)
+                for url, oks in (producer.pop("endpoint_oks") or {}).items()
+            }
+        summary["producers"].append(producer)
+    return summary
+
+
+def diff(old, new):
+    """Changes from summary old to summary new, {} if there are none"""
+    changes = {}
+    for key in sorted(set(old) | set(new)):
+        if key in VOLATILE or key == "producers":
+            continue
+        if key.startswith("healthy_"):
+            before, after = set(old.get(key, [])), set(new.get(key, []))
+            if before != after:
+                changes[key] = {
+                    "added": sorted(after - before),
+                    "removed": sorted(before - after),
+                }
+        elif old.get(key) != new.get(key):
+            changes[key] = new.get(key)
+
+    before = {producer["account"]: producer for producer in old.get("producers", [])}
+    after = {producer["account"]: producer for producer in new.get("producers", [])}
+    producers = {}
+    for account in sorted(set(before) | set(after)):
+        if account not in after:
+            producers[account] = None
+        elif account not in before:
+            producers[account] = after[account]
+        else:
+            change = diff_producer(before[account], after[account])
+            if change:
+                producers[account] = change
+    if producers:
+        changes["producers"] = producers
+    return changes
+
+
+def diff_producer(old, new):
+    change = {}
+    for key in sorted(set(old) | set(new)):
+        if key in ENDPOINT_FIELDS:
+            endpoints = diff_endpoints(old.get(key) or {}, new.get(key) or {})
+            if endpoints:
+                change[key] = endpoints
+        elif key in UNORDERED:
+            if sorted(old.get(key) or []) != sorted(new.get(key) or []):
+                change[key] = new.get(key)
+        elif old.get(key) != new.get(key):
+            change[key] = new.get(key)
+    return change
+
+
+def diff_endpoints(old, new):
+    return {
+        url: new.get(url)
+        for url in sorted(set(old) | set(new))
+        if old.get(url) != new.get(url)
+    }
@@ -1,3 +1,4 @@
+import asyncio
 import requests
 import humanize
 import socket
@@ -5,27 +6,103 @@ import eospy.cleos
 import datetime
 import dateutil.parser
 from urllib.parse import urljoin
-from tenacity import retry
-from tenacity.stop import stop_after_attempt
-from tenacity.wait import wait_fixed
 import pprint
-import time
 import json
-from deepdiff import DeepDiff
+import copy
+from include.pool import HttpPool
+from include.canonical import HashCache, diff, document_hash
+from include.document import DocumentFetcher
+from include.dns import Resolver
+from include import latency, p2p
+from include.ratelimit import host_of
 
 pp = pprint.PrettyPrinter(indent=4)
-DELAY = 0.3
+
+# bp.json feature -> probe kind, in the order run_checks executes them
+FEATURE_PROBES = [
+    ("chain-api", "api"),
+    ("account-query", "account_query"),
+    ("history-v1", "history"),
+    ("hyperion-v2", "hyperion"),
+    ("atomic-assets-api", "atomic"),
+    ("ipfs", "ipfs"),
+    ("light-api", "lightapi"),
+]
+
+PROBE_METHODS = {
+    "api": "check_api",
+    "account_query": "check_account_query",
+    "history": "check_history",
+    "hyperion": "check_hyperion",
+    "atomic": "check_atomic",
+    "ipfs": "check_ipfs",
+    "lightapi": "check_lightapi",
+    "p2p": "check_p2p",
+}
+
+HEALTHY_LISTS = {
+    "api": "healthy_api_endpoints",
+    "history": "healthy_history_endpoints",
+    "hyperion": "healthy_hyperion_endpoints",
+    "atomic": "healthy_atomic_endpoints",
+    "ipfs": "healthy_ipfs_endpoints",
+    "lightapi": "healthy_lightapi_endpoints",
+    "p2p": "healthy_p2p_endpoints",
+}
+
+
+class ProbeResult:
+    def __init__(
+        self, kind, url, errors, oks, healthy, status, wrong_chain_id, timings=None
+    ):
+        self.kind = kind
+        self.url = url
+        self.errors = errors
+        self.oks = oks
+        self.healthy = healthy
+        self.status = status
+        self.wrong_chain_id = wrong_chain_id
+        # {metric: [seconds]} of the requests made, see include/latency.py
+        self.timings = timings or {}
+
+    def outcome(self):
+        return (self.errors, self.oks, self.healthy, self.status, self.wrong_chain_id)
+
+    def __eq__(self, other):
+        return isinstance(other, ProbeResult) and (
+            (self.kind, self.url, self.outcome())
+            == (other.kind, other.url, other.outcome())
+        )
 
 
 class Checker:
-    def __init__(self, chain_info, producer, logging):
+    def __init__(
+        self,
+        chain_info,
+        producer,
+        logging,
+        http=None,
+        cache=None,
+        onchain_index=None,
+        hashes=None,
+        resolver=None,
+        documents=None,
+    ):
         self.chain_info = chain_info
+        self.http = http or HttpPool()
+        self.resolver = resolver or Resolver()
+        self.documents = documents or DocumentFetcher()
+        self.cache = cache
+        self.hashes = hashes or HashCache()
+        # owner -> producerjson row, see ProducerJsonIndex
+        self.onchain_index = onchain_index
         self.wrong_chain_id = False
         self.logging = logging
         self.producer_info = producer
         self.org_name = self.producer_info["owner"]
         self.bp_json = None
-        self.bp_json_string = "{}"
+        # Canonical hash of the bp.json as served, see compare_onchain_bpjson
+        self.bp_json_hash = document_hash({})
         self.status = 0
         self.errors = []
         self.oks = []
@@ -44,12 +121,19 @@ class Checker:
         self.nodes = []
         self.endpoints = []
         self.onchain_bp_json = False
+        self.timings = {}
+
+    def get_document(self, url, timeout, headers=None):
+        """GET a JSON document the producer publishes, through the cache if any"""
+        if self.cache:
+            return self.cache.get(
+                url, headers=headers, timeout=timeout, http=self.http
+            )
+        return self.documents.fetch(self.http, url, headers=headers, timeout=timeout)
 
-    @retry(stop=stop_after_attempt(2), wait=wait_fixed(2), reraise=True)
     def get_producer_chainsjson_path(self, url, chain_id, timeout):
-        time.sleep(DELAY)
         try:
-            chains_json_content = requests.get(url, timeout=timeout).json()
+            chains_json_content = self.get_document(url, timeout).json()
             return chains_json_content["chains"][chain_id]
         except Exception as e:
             self.logging.critical(
@@ -57,12 +141,13 @@ class Checker:
             )
             return None
 
-    @retry(stop=stop_after_attempt(2), wait=wait_fixed(2), reraise=True)
     def get_onchain_bpjson(self, timeout):
-        time.sleep(DELAY)
+        PRODUCER = self.producer_info["owner"]
+        if self.onchain_index is not None:
+            return self.compare_onchain_bpjson(self.onchain_index.get(PRODUCER))
+
         API_NODE = self.chain_info["api_node"]
         ENDPOINT = f"{API_NODE}/v1/chain/get_table_rows"
-        PRODUCER = self.producer_info["owner"]
 
         payload = {
             "json": True,
@@ -78,37 +163,42 @@ class Checker:
             "show_payer": True,
         }
 
-        response = requests.post(ENDPOINT, json=payload, timeout=timeout)
+        response = self.http.post(ENDPOINT, json=payload, timeout=timeout)
         if response.status_code != 200:
             msg = f"Error getting bpjson on chain for producer {PRODUCER}"
             self.logging.critical(msg)
             print(response.text)
             return
         else:
-            result = response.json()
-            if len(result["rows"]) < 1:
-                msg = f"No bpjson on chain for producer {PRODUCER}"
-                self.warnings.append(msg)
-                self.logging.critical(msg)
+            rows = response.json()["rows"]
+            self.compare_onchain_bpjson(rows[0]["data"]["json"] if rows else None)
+
+    def compare_onchain_bpjson(self, content):
+        """Compare the bp.json stored in the producerjson table, None if the
+        producer has none, with the one served online"""
+        PRODUCER = self.producer_info["owner"]
+        if content is None:
+            msg = f"No bpjson on chain for producer {PRODUCER}"
+            self.warnings.append(msg)
+            self.logging.critical(msg)
+        else:
+            # An unparseable record compares as {} like before
+            onchain_hash = self.hashes.get(content) or self.hashes.get("{}")
+            if onchain_hash == self.bp_json_hash:
+                msg = f"bpjson on chain for producer {PRODUCER} matches the one online"
+                self.oks.append(msg)
+                self.logging.info(msg)
             else:
                 try:
-                    onchain_bpjson = json.loads(result["rows"][0]["data"]["json"])
+                    onchain_bpjson = json.loads(content)
                 except:
                     onchain_bpjson = {}
-                online_bpjson = json.loads(self.bp_json_string)
-                diff = DeepDiff(onchain_bpjson, online_bpjson)
-                if not diff:
-                    msg = f"bpjson on chain for producer {PRODUCER} matches the one online"
-                    self.oks.append(msg)
-                    self.logging.info(msg)
-                else:
-                    msg = f"bpjson on chain for producer {PRODUCER} doesnt match the one online"
-                    self.warnings.append(msg)
-                    self.logging.critical(msg, diff)
-
-    @retry(stop=stop_after_attempt(2), wait=wait_fixed(2), reraise=True)
+                changes = diff(onchain_bpjson, self.bp_json or {})
+                msg = f"bpjson on chain for producer {PRODUCER} doesnt match the one online"
+                self.warnings.append(msg)
+                self.logging.critical("{}: {}".format(msg, "; ".join(changes)))
+
     def get_bpjson(self, timeout):
-        time.sleep(DELAY)
         has_ssl_endpoints = False
         has_p2p_endpoints = False
         has_api_endpoints = False
@@ -129,8 +219,8 @@ class Checker:
             headers = {
                 "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36"
             }
-            response = requests.get(
-                self.producer_info["bp_json_url"], headers=headers, timeout=timeout
+            response = self.get_document(
+                self.producer_info["bp_json_url"], timeout, headers=headers
             )
 
             if response.status_code != 200:
@@ -148,7 +238,7 @@ class Checker:
                 return
 
             self.bp_json = response.json()
-            self.bp_json_string = response.text
+            self.bp_json_hash = response.hash
 
             if "org" in self.bp_json:
                 self.org = self.bp_json["org"]
@@ -245,47 +335,64 @@ class Checker:
             self.logging.critical(msg)
             self.errors.append(msg)
 
-    @retry(stop=stop_after_attempt(2), wait=wait_fixed(2))
     def check_p2p(self, url, timeout):
-        time.sleep(DELAY)
+        self.http.pace(url)
+        asyncio.run(self.probe_p2p(url, timeout))
+
+    async def probe_p2p(self, url, timeout):
+        """Handshake with a p2p endpoint; the host should be in the
+        resolver's cache already, the lookup blocks otherwise"""
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(timeout)
             host, port = url.split(":")
-            result = sock.connect_ex((host, int(port)))
-            if result != 0:
-                self.status = 2
-                self.endpoint_errors[url].append("Error connecting to {}".format(url))
-                self.logging.critical("Error connecting to {}".format(url))
-                return
-        except ValueError as e:
+            port = int(port)
+        except ValueError:
             self.status = 2
             self.endpoint_errors[url].append(
                 "Invalid p2p host:port value {}".format(url)
             )
             self.logging.critical("Invalid p2p host:port value {}".format(url))
+            return
+
+        try:
+            addresses = self.resolver.addresses(host, socket.AF_INET)
+            # Each address in turn until one accepts, as create_connection does
+            for num, address in enumerate(addresses):
+                try:
+                    timings = await p2p.probe(
+                        address, port, self.chain_info["chain_id"], timeout
+                    )
+                    break
+                except (OSError, asyncio.TimeoutError):
+                    if num == len(addresses) - 1:
+                        raise
+        except asyncio.TimeoutError:
+            msg = "Timeout connecting to {}".format(url)
+        except p2p.P2PError as e:
+            msg = "P2P handshake with {} failed: {}".format(url, e)
         except Exception as e:
+            msg = "Error connecting to {}: {}".format(url, e)
+        else:
+            msg = None
+
+        if msg:
             self.status = 2
-            self.endpoint_errors[url].append(
-                "Error connecting to {}: {}".format(url, e)
-            )
-            self.logging.critical(
-                "Error connecting to {}: {} {}".format(url, type(e), e)
-            )
+            self.endpoint_errors[url].append(msg)
+            self.logging.critical(msg)
+            return
 
+        self.timings["connect"] = [timings["connect"]]
+        self.timings["ttfb"] = [timings["handshake"]]
+        self.timings["total"] = [timings["connect"] + timings["handshake"]]
         self.healthy_p2p_endpoints.append(url)
-        msg = "P2P node {} is responding".format(url)
+        msg = "P2P node {} answered with a {} message".format(url, timings["message"])
         self.logging.info(msg)
-        print(self.endpoint_oks)
         self.endpoint_oks[url].append(msg)
 
-    @retry(stop=stop_after_attempt(2), wait=wait_fixed(2), reraise=True)
     def check_api(self, url, chain_id, timeout):
-        time.sleep(DELAY)
         errors_found = False
         try:
             api_url = f'{url.rstrip("/")}/v1/chain/get_info'
-            response = requests.get(api_url, timeout=timeout)
+            response = self.http.get(api_url, timeout=timeout)
             if response.status_code != 200:
                 self.status = 2
                 msg = "Error connecting to {}: {}".format(
@@ -361,13 +468,11 @@ class Checker:
             self.logging.info(msg)
             self.endpoint_oks[url].append(msg)
 
-    @retry(stop=stop_after_attempt(1), wait=wait_fixed(2), reraise=True)
     def check_history(self, url, timeout):
-        time.sleep(DELAY)
         try:
             history_url = f'{url.rstrip("/")}/v1/history/get_actions'
             payload = {"account_name":"eosio","pos":-1, "offset":-3}
-            response = requests.post(history_url, timeout=timeout, json=payload)
+            response = self.http.post(history_url, timeout=timeout, json=payload)
             if not "actions" in response.json():
                 self.logging.info("No actions in response")
                 return
@@ -388,13 +493,11 @@ class Checker:
         self.endpoint_oks[url].append(msg)
         self.logging.info(msg)
 
-    @retry(stop=stop_after_attempt(1), wait=wait_fixed(2), reraise=True)
     def check_account_query(self, url, timeout):
-        time.sleep(DELAY)
         try:
             account = "ledgerwiseio"
             api_url = "{}/v1/chain/get_accounts_by_authorizers".format(url.rstrip("/"))
-            response = requests.post(
+            response = self.http.post(
                 api_url,
                 json={
                     "json": True,
@@ -424,14 +527,12 @@ class Checker:
             self.logging.error(msg)
             return
 
-    @retry(stop=stop_after_attempt(1), wait=wait_fixed(2), reraise=True)
     def check_hyperion(self, url, timeout):
-        time.sleep(DELAY)
         errors_found = False
         try:
             # Check last hyperion indexed action
             history_url = "{}/v2/history/get_actions?limit=1".format(url.rstrip("/"))
-            response = requests.get(history_url, timeout=timeout)
+            response = self.http.get(history_url, timeout=timeout)
             if response.status_code != 200:
                 self.logging.info("No hyperion found ({})".format(response.status_code))
                 self.endpoint_errors[url].append(
@@ -457,7 +558,7 @@ class Checker:
 
             # Check hyperion service health
             health_url = "{}/v2/health".format(url.rstrip("/"))
-            response = requests.get(health_url, timeout=timeout)
+            response = self.http.get(health_url, timeout=timeout)
             if response.status_code != 200:
                 msg = "Error {} trying to check hyperion health endpoint".format(
                     response.status_code
@@ -513,14 +614,12 @@ class Checker:
             self.endpoint_oks[url].append(msg)
             self.logging.info(msg)
 
-    @retry(stop=stop_after_attempt(1), wait=wait_fixed(2), reraise=True)
     def check_atomic(self, url, timeout):
-        time.sleep(DELAY)
         errors_found = False
         try:
             # Check atomic service health
             health_url = "{}/health".format(url.rstrip("/"))
-            response = requests.get(health_url, timeout=timeout)
+            response = self.http.get(health_url, timeout=timeout)
             if response.status_code != 200:
                 msg = "Error {} trying to check atomic health endpoint".format(
                     response.status_code
@@ -570,13 +669,11 @@ class Checker:
             self.logging.info(msg)
 
 
-    @retry(stop=stop_after_attempt(1), wait=wait_fixed(3), reraise=True)
     def check_ipfs(self, url, timeout):
-        time.sleep(DELAY)
         try:
             path = "/ipfs/QmWnfdZkwWJxabDUbimrtaweYF8u9TaESDBM8xvRxxbQxv"
             api_url = urljoin(url.rstrip("/"), path)
-            response = requests.get(api_url, timeout=timeout)
+            response = self.http.get(api_url, timeout=timeout)
             if response.status_code != 200:
                 print(response.text)
                 print(response.status_code)
@@ -599,13 +696,11 @@ class Checker:
             self.logging.error(msg)
             return
 
-    @retry(stop=stop_after_attempt(1), wait=wait_fixed(3), reraise=True)
     def check_lightapi(self, url, timeout):
-        time.sleep(DELAY)
         try:
             path = "/api/status"
             api_url = urljoin(url.rstrip("/"), path)
-            response = requests.get(api_url, timeout=timeout)
+            response = self.http.get(api_url, timeout=timeout)
             if response.status_code != 200:
                 self.status = 2
                 msg = f"Light API error: {response.status_code}"
@@ -625,102 +720,120 @@ class Checker:
             self.logging.error(msg)
             return
 
+    def plan_checks(self):
+        """Return the (kind, url) probes run_checks performs, in order"""
+        plan = []
+        if not self.nodes:
+            return plan
+        for node in self.bp_json["nodes"]:
+            if (
+                "node_type" in node
+                and "query" in node["node_type"]
+                and "features" in node
+            ):
+                for feature, kind in FEATURE_PROBES:
+                    if feature in node["features"]:
+                        for key in ("api_endpoint", "ssl_endpoint"):
+                            if key in node:
+                                plan.append((kind, node[key]))
+
+            if "node_type" in node and "seed" in node["node_type"]:
+                if "p2p_endpoint" in node:
+                    plan.append(("p2p", node["p2p_endpoint"]))
+        return plan
+
+    def probe(self, kind, url):
+        timeout = self.chain_info["timeout"]
+        if kind == "api":
+            self.check_api(url, self.chain_info["chain_id"], timeout)
+        else:
+            getattr(self, PROBE_METHODS[kind])(url, timeout)
+
+    def run_probe(self, kind, url):
+        """Run one probe against a scratch checker and return its outcome
+
+        Probes write straight into the checker state, so running them on a
+        scratch instance lets callers execute them concurrently and merge
+        the outcomes back in plan order with apply_probe.
+        """
+        scratch = self.scratch(url)
+        if not scratch.status:
+            recorded = latency.record()
+            try:
+                scratch.probe(kind, url)
+            finally:
+                latency.stop()
+            scratch.timings.update(recorded)
+        return scratch.result(kind, url)
+
+    async def run_p2p_probe(self, url):
+        """run_probe("p2p", url) on the caller's event loop"""
+        scratch = self.scratch(url)
+        if not scratch.status:
+            await scratch.probe_p2p(url, self.chain_info["timeout"])
+        return scratch.result("p2p", url)
+
+    def scratch(self, url):
+        scratch = Checker(
+            self.chain_info,
+            self.producer_info,
+            self.logging,
+            http=self.http,
+            resolver=self.resolver,
+        )
+        scratch.endpoint_errors[url] = []
+        scratch.endpoint_oks[url] = []
+        # A host that doesn't resolve fails the probe without a request
+        host = host_of(url)
+        dns_error = self.resolver.error(host)
+        if dns_error:
+            scratch.status = 2
+            scratch.endpoint_errors[url].append(dns_error)
+            self.logging.critical(dns_error)
+        else:
+            seconds = self.resolver.seconds(host)
+            if seconds is not None:
+                scratch.timings["dns"] = [seconds]
+        return scratch
+
+    def result(self, kind, url):
+        healthy = HEALTHY_LISTS.get(kind)
+        return ProbeResult(
+            kind,
+            url,
+            errors=self.endpoint_errors[url],
+            oks=self.endpoint_oks[url],
+            healthy=healthy is not None and url in getattr(self, healthy),
+            status=self.status,
+            wrong_chain_id=self.wrong_chain_id,
+            timings=self.timings,
+        )
+
+    def apply_probe(self, result):
+        self.endpoint_errors[result.url] += result.errors
+        self.endpoint_oks[result.url] += result.oks
+        if result.healthy:
+            getattr(self, HEALTHY_LISTS[result.kind]).append(result.url)
+        if result.status:
+            self.status = result.status
+        if result.wrong_chain_id:
+            self.wrong_chain_id = True
+
+    def clone(self):
+        """Copy of this checker to merge probe results into, leaving the
+        bp.json stage state of the original untouched"""
+        checker = copy.copy(self)
+        for name in ["errors", "oks", "warnings"] + list(HEALTHY_LISTS.values()):
+            setattr(checker, name, list(getattr(self, name)))
+        checker.endpoint_errors = {k: list(v) for k, v in self.endpoint_errors.items()}
+        checker.endpoint_oks = {k: list(v) for k, v in self.endpoint_oks.items()}
+        return checker
+
     def run_checks(self):
         self.get_bpjson(timeout=self.chain_info["timeout"])
         if self.chain_info["name"] == "WAX":
             self.get_onchain_bpjson(timeout=self.chain_info["timeout"])
-        if self.nodes:
-            for node in self.bp_json["nodes"]:
-                if (
-                    "node_type" in node
-                    and "query" in node["node_type"]
-                    and "features" in node
-                ):
-                    # Check API
-                    if "chain-api" in node["features"]:
-                        if "api_endpoint" in node:
-                            self.check_api(
-                                node["api_endpoint"],
-                                self.chain_info["chain_id"],
-                                self.chain_info["timeout"],
-                            )
-                            if self.wrong_chain_id:
-                                return
-                        if "ssl_endpoint" in node:
-                            self.check_api(
-                                node["ssl_endpoint"],
-                                self.chain_info["chain_id"],
-                                self.chain_info["timeout"],
-                            )
-                            if self.wrong_chain_id:
-                                return
-                    # Check Account Query
-                    if "account-query" in node["features"]:
-                        if "api_endpoint" in node:
-                            self.check_account_query(
-                                node["api_endpoint"], self.chain_info["timeout"]
-                            )
-                        if "ssl_endpoint" in node:
-                            self.check_account_query(
-                                node["ssl_endpoint"], self.chain_info["timeout"]
-                            )
-
-                    # Check History V1
-                    if "history-v1" in node["features"]:
-                        if "api_endpoint" in node:
-                            self.check_history(
-                                node["api_endpoint"], self.chain_info["timeout"]
-                            )
-                        if "ssl_endpoint" in node:
-                            self.check_history(
-                                node["ssl_endpoint"], self.chain_info["timeout"]
-                            )
-
-                    # Check Hyperion
-                    if "hyperion-v2" in node["features"]:
-                        if "api_endpoint" in node:
-                            self.check_hyperion(
-                                node["api_endpoint"], self.chain_info["timeout"]
-                            )
-                        if "ssl_endpoint" in node:
-                            self.check_hyperion(
-                                node["ssl_endpoint"], self.chain_info["timeout"]
-                            )
-
-                    # Check Hyperion
-                    if "atomic-assets-api" in node["features"]:
-                        if "api_endpoint" in node:
-                            self.check_atomic(
-                                node["api_endpoint"], self.chain_info["timeout"]
-                            )
-                        if "ssl_endpoint" in node:
-                            self.check_atomic(
-                                node["ssl_endpoint"], self.chain_info["timeout"]
-                            )
-
-                    # Check IPFS
-                    if "ipfs" in node["features"]:
-                        if "api_endpoint" in node:
-                            self.check_ipfs(
-                                node["api_endpoint"], self.chain_info["timeout"]
-                            )
-                        if "ssl_endpoint" in node:
-                            self.check_ipfs(
-                                node["ssl_endpoint"], self.chain_info["timeout"]
-                            )
-
-                    # Check lightapi
-                    if "light-api" in node["features"]:
-                        if "api_endpoint" in node:
-                            self.check_lightapi(
-                                node["api_endpoint"], self.chain_info["timeout"]
-                            )
-                        if "ssl_endpoint" in node:
-                            self.check_lightapi(
-                                node["ssl_endpoint"], self.chain_info["timeout"]
-                            )
-
-                if "node_type" in node and "seed" in node["node_type"]:
-                    # Check P2P
-                    if "p2p_endpoint" in node:
-                        self.check_p2p(node["p2p_endpoint"], self.chain_info["timeout"])
+        for kind, url in self.plan_checks():
+            self.apply_probe(self.run_probe(kind, url))
+            if self.wrong_chain_id:
+                return
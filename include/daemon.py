@@ -0,0 +1,208 @@
+import asyncio
+import time
+
+TICK = 1
+HEALTHY_INTERVAL = 300
+FAILING_INTERVAL = 60
+BPJSON_INTERVAL = 3600
+PRODUCERS_INTERVAL = 900
+PUBLISH_INTERVAL = 10
+ARCHIVE_INTERVAL = 3600
+
+
+class ProducerState:
+    def __init__(self, producer):
+        self.producer = producer
+        self.checker = None
+        self.plan = []
+        self.results = {}
+        self.due = {}
+        self.bpjson_due = 0
+
+    def ready(self):
+        return self.checker is not None and all(
+            key in self.results for key in self.plan
+        )
+
+    def assemble(self):
+        """Checker with the current probe results merged in plan order"""
+        checker = self.checker.clone()
+        for key in self.plan:
+            checker.apply_probe(self.results[key])
+            if checker.wrong_chain_id:
+                break
+        return checker
+
+
+class ChainMonitor:
+    """Keeps one chain's producers, bp.json documents and probe results in
+    memory and re-checks each piece on its own schedule
+
+    Passing probes are repeated every healthy_interval seconds, failing ones
+    every failing_interval, bp.json every bpjson_interval and the producer
+    list every producers_interval. The chain is published again, at most
+    every publish_interval seconds, only when something changed, with the
+    engine's timings since the previous publish. Every archive_interval
+    seconds, changed or not, the publish also archives it: its latency
+    samples go to the history store, which records the day and rebuilds
+    the bundle, as every publish of a one-shot run does.
+    """
+
+    def __init__(self, chain_info, engine, get_producers, publish, settings, logging):
+        self.chain_info = chain_info
+        self.engine = engine
+        self.get_producers = get_producers
+        self.publish = publish
+        self.logging = logging
+        self.healthy_interval = settings.get("healthy_interval", HEALTHY_INTERVAL)
+        self.failing_interval = settings.get("failing_interval", FAILING_INTERVAL)
+        self.bpjson_interval = settings.get("bpjson_interval", BPJSON_INTERVAL)
+        self.producers_interval = settings.get("producers_interval", PRODUCERS_INTERVAL)
+        self.publish_interval = settings.get("publish_interval", PUBLISH_INTERVAL)
+        self.archive_interval = settings.get("archive_interval", ARCHIVE_INTERVAL)
+        self.producers = []
+        self.states = {}
+        self.producers_due = 0
+        self.publish_due = 0
+        self.archive_due = 0
+        self.dirty = False
+        self.inflight = set()
+
+    async def run(self):
+        self.engine.open()
+        try:
+            while True:
+                self.schedule()
+                await self.flush()
+                await asyncio.sleep(TICK)
+        finally:
+            self.engine.close(wait=False)
+
+    def schedule(self):
+        now = time.monotonic()
+        if now >= self.producers_due:
+            self.spawn("producers", self.refresh_producers())
+        for owner, state in self.states.items():
+            if now >= state.bpjson_due:
+                self.spawn(("bpjson", owner), self.refresh_bpjson(state))
+            if state.checker is None:
+                continue
+            for key, due in state.due.items():
+                if now >= due:
+                    self.spawn((owner,) + key, self.refresh_probe(state, key))
+
+    def spawn(self, name, coro):
+        if name in self.inflight:
+            coro.close()
+            return
+        self.inflight.add(name)
+        task = asyncio.ensure_future(coro)
+        task.add_done_callback(lambda task: self.done(name, task))
+
+    def done(self, name, task):
+        self.inflight.discard(name)
+        if not task.cancelled() and task.exception():
+            self.logging.critical(
+                "Error refreshing {} on {}: {}".format(
+                    name, self.chain_info["name"], task.exception()
+                )
+            )
+
+    async def refresh_producers(self):
+        try:
+            producers = await asyncio.to_thread(
+                self.engine.timings.timed(
+                    "get_producers", self.get_producers, phase=True
+                ),
+                self.chain_info,
+            )
+        except Exception as e:
+            self.logging.critical("Too many retries getting producers")
+            self.producers_due = time.monotonic() + self.failing_interval
+            return
+        self.producers_due = time.monotonic() + self.producers_interval
+
+        states = {}
+        for producer in producers:
+            state = self.states.get(producer["owner"])
+            if state is None or state.producer["url"] != producer["url"]:
+                state = ProducerState(producer)
+            else:
+                # get_bpjson may have pointed bp_json_url at chains.json
+                producer["bp_json_url"] = state.producer["bp_json_url"]
+                state.producer.update(producer)
+            states[producer["owner"]] = state
+
+        if [p["owner"] for p in producers] != [p["owner"] for p in self.producers]:
+            self.dirty = True
+        self.producers = [states[p["owner"]].producer for p in producers]
+        self.states = states
+
+    async def refresh_bpjson(self, state):
+        checker = self.engine.checker(state.producer)
+        plan = await self.engine.prepare(checker)
+        interval = (
+            self.failing_interval if checker.bp_json is None else self.bpjson_interval
+        )
+        state.bpjson_due = time.monotonic() + interval
+
+        previous = state.checker
+        if previous is None or (
+            checker.bp_json,
+            checker.errors,
+            checker.oks,
+            checker.warnings,
+            checker.org_name,
+        ) != (
+            previous.bp_json,
+            previous.errors,
+            previous.oks,
+            previous.warnings,
+            previous.org_name,
+        ):
+            self.dirty = True
+        if plan != state.plan:
+            self.dirty = True
+
+        state.checker = checker
+        state.plan = plan
+        state.results = {k: v for k, v in state.results.items() if k in plan}
+        state.due = {key: state.due.get(key, 0) for key in plan}
+
+    async def refresh_probe(self, state, key):
+        kind, url = key
+        result = await self.engine.probe(state.checker, kind, url)
+        if key not in state.due:
+            return
+
+        if result != state.results.get(key):
+            self.dirty = True
+        state.results[key] = result
+        interval = self.failing_interval if result.errors else self.healthy_interval
+        state.due[key] = time.monotonic() + interval
+
+    async def flush(self):
+        now = time.monotonic()
+        archive = now >= self.archive_due
+        if not (self.dirty or archive) or now < self.publish_due or not self.producers:
+            return
+        states = [self.states[p["owner"]] for p in self.producers]
+        if not all(state.ready() for state in states):
+            return
+
+        self.dirty = False
+        self.publish_due = now + self.publish_interval
+        if archive:
+            self.archive_due = now + self.archive_interval
+        checkers = [state.assemble() for state in states]
+        await self.publish(
+            self.chain_info,
+            self.producers,
+            checkers,
+            # Kept until the next archive otherwise
+            self.engine.latency.drain() if archive else None,
+            self.engine.timings,
+            archive=archive,
+        )
+        await asyncio.to_thread(self.engine.save)
+        self.logging.info("Published chain {}".format(self.chain_info["name"]))
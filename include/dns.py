@@ -0,0 +1,165 @@
+import socket
+import threading
+import time
+from urllib3.connection import HTTPSConnection
+from urllib3.exceptions import (
+    ConnectTimeoutError,
+    NameResolutionError,
+    NewConnectionError,
+)
+from include import latency
+
+TTL = 300
+NEGATIVE_TTL = 60
+
+
+class Resolver:
+    """Caching resolver shared by the HTTP pool and the p2p probes
+
+    Each host is looked up once and its addresses kept for ttl seconds;
+    failed lookups are kept for negative_ttl seconds so a host that doesn't
+    exist fails right away for every endpoint on it. getaddrinfo doesn't
+    return record TTLs, so both are fixed in config.json. Concurrent
+    lookups of the same host wait for a single query.
+    """
+
+    def __init__(self, ttl=TTL, negative_ttl=NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.entries = {}
+        self.lookups = 0
+        self.hits = 0
+        self.failures = 0
+
+    @classmethod
+    def from_config(cls, CONFIG):
+        settings = CONFIG.get("dns", {})
+        return cls(
+            ttl=settings.get("ttl", TTL),
+            negative_ttl=settings.get("negative_ttl", NEGATIVE_TTL),
+        )
+
+    def cached(self, host):
+        with self.lock:
+            entry = self.entries.get(host)
+        return entry is not None and entry["expires"] > time.monotonic()
+
+    def resolve(self, host):
+        """Cache entry for host: {"addresses": [...], "error": gaierror or None}"""
+        with self.lock:
+            lock = self.locks.setdefault(host, threading.Lock())
+        with lock:
+            with self.lock:
+                entry = self.entries.get(host)
+                if entry is not None and entry["expires"] > time.monotonic():
+                    self.hits += 1
+                    return entry
+                self.lookups += 1
+            started = time.monotonic()
+            try:
+                infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+                addresses = [(info[0], info[4][0]) for info in infos]
+                entry = {"addresses": addresses, "error": None}
+                ttl = self.ttl
+            except socket.gaierror as e:
+                entry = {"addresses": [], "error": e}
+                ttl = self.negative_ttl
+                with self.lock:
+                    self.failures += 1
+            entry["seconds"] = time.monotonic() - started
+            entry["expires"] = time.monotonic() + ttl
+            with self.lock:
+                self.entries[host] = entry
+            return entry
+
+    def addresses(self, host, family=None):
+        """Addresses of host in getaddrinfo order, of the given family if
+        any; raises socket.gaierror if it has none"""
+        entry = self.resolve(host)
+        if entry["error"] is not None:
+            raise entry["error"]
+        addresses = []
+        for af, address in entry["addresses"]:
+            if (family is None or af == family) and address not in addresses:
+                addresses.append(address)
+        if not addresses:
+            raise socket.gaierror(
+                socket.EAI_NONAME, "No {} address for {}".format(family.name, host)
+            )
+        return addresses
+
+    def address(self, host, family=None):
+        """First address of host, of the given family if any; raises
+        socket.gaierror if it has none"""
+        return self.addresses(host, family)[0]
+
+    def error(self, host):
+        """Endpoint error for a host that can't be resolved, None if it can"""
+        if not host:
+            return None
+        error = self.resolve(host)["error"]
+        if error is None:
+            return None
+        if error.errno in (socket.EAI_NONAME, getattr(socket, "EAI_NODATA", None)):
+            return "DNS lookup failed for {}: host not found".format(host)
+        return "DNS lookup failed for {}: {}".format(host, error)
+
+    def seconds(self, host):
+        """How long the last lookup of host took, to the first caller after
+        it only so the lookup is counted once; None for the others or if
+        there was none"""
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is None or entry.get("reported"):
+                return None
+            entry["reported"] = True
+            return entry["seconds"]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hosts": len(self.entries),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "failures": self.failures,
+            }
+
+
+def resolving(connection_cls, resolver):
+    """urllib3 connection class that connects to resolver's addresses for
+    its host, each in turn until one answers as create_connection does,
+    leaving the host name for SNI and the Host header; marks connect and
+    TLS handshake times, see latency.mark"""
+
+    class ResolvingConnection(connection_cls):
+        def connect(self):
+            self.connected_at = None
+            super().connect()
+            if isinstance(self, HTTPSConnection) and self.connected_at is not None:
+                latency.mark("tls", time.monotonic() - self.connected_at)
+
+        def _new_conn(self):
+            host = self._dns_host
+            try:
+                addresses = resolver.addresses(host)
+            except socket.gaierror as e:
+                raise NameResolutionError(self.host, self, e) from e
+            started = time.monotonic()
+            try:
+                for num, address in enumerate(addresses):
+                    self._dns_host = address
+                    try:
+                        sock = super()._new_conn()
+                    except (NewConnectionError, ConnectTimeoutError):
+                        if num == len(addresses) - 1:
+                            raise
+                        continue
+                    self.connected_at = time.monotonic()
+                    latency.mark("connect", self.connected_at - started)
+                    return sock
+            finally:
+                self._dns_host = host
+
+    return ResolvingConnection
@@ -0,0 +1,131 @@
+import codecs
+import json
+import threading
+import time
+from include.canonical import document_hash
+
+MAX_BYTES = 1024 * 1024
+READ_TIMEOUT = 10
+ERROR_BYTES = 1024
+CHUNK_SIZE = 16 * 1024
+JSON_TYPES = ("application/json", "text/json", "text/plain", "application/octet-stream")
+
+
+class DocumentError(ValueError):
+    pass
+
+
+class Document:
+    """What readers of bp.json and chains.json use of a response: the
+    status, the parsed document and, only where it is kept, the body
+
+    hash is the canonical hash of the document as parsed, before any
+    reader changed it; the cache hands the same document to every reader.
+    """
+
+    def __init__(self, status_code, text=None, document=None, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.document = document
+        self.hash = None if document is None else document_hash(document)
+        self.headers = headers or {}
+
+    def json(self):
+        if self.document is None:
+            self.document = json.loads(self.text)
+            self.hash = document_hash(self.document)
+        return self.document
+
+
+def json_type(content_type):
+    """Whether a Content-Type may hold JSON; no Content-Type at all may"""
+    if not content_type:
+        return True
+    mime = content_type.split(";")[0].strip().lower()
+    return mime in JSON_TYPES or mime.endswith("+json")
+
+
+class DocumentFetcher:
+    """Streams the JSON documents producers publish
+
+    The body is read in chunks into a single buffer and parsed from it
+    once, so no copy of it as text is made unless asked for. A fetch is
+    abandoned as soon as the body turns out to be more than max_bytes,
+    to not be JSON going by its Content-Type, or to take more than
+    read_timeout seconds to arrive.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, read_timeout=READ_TIMEOUT):
+        self.max_bytes = max_bytes
+        self.read_timeout = read_timeout
+        self.lock = threading.Lock()
+        self.fetched = 0
+        self.bytes = 0
+
+    @classmethod
+    def from_config(cls, CONFIG):
+        settings = CONFIG.get("documents", {})
+        return cls(
+            max_bytes=settings.get("max_bytes", MAX_BYTES),
+            read_timeout=settings.get("read_timeout", READ_TIMEOUT),
+        )
+
+    def fetch(self, http, url, headers=None, timeout=None, keep_text=False):
+        """GET url as a Document; keep_text also keeps the body as text.
+        Non-200 answers only carry the start of their body."""
+        response = http.get(url, headers=headers, timeout=timeout, stream=True)
+        try:
+            if response.status_code != 200:
+                body = self.read(response, ERROR_BYTES, truncate=True)
+                return Document(
+                    response.status_code,
+                    text=body.decode("utf-8", "replace"),
+                    headers=response.headers,
+                )
+
+            content_type = response.headers.get("Content-Type")
+            if not json_type(content_type):
+                raise DocumentError("Unexpected content type {}".format(content_type))
+            body = self.read(response, self.max_bytes)
+            with self.lock:
+                self.fetched += 1
+                self.bytes += len(body)
+            if body.startswith(codecs.BOM_UTF8):
+                del body[: len(codecs.BOM_UTF8)]
+            document = json.loads(body)
+            return Document(
+                200,
+                text=body.decode("utf-8") if keep_text else None,
+                document=document,
+                headers=response.headers,
+            )
+        finally:
+            response.close()
+
+    def stats(self):
+        with self.lock:
+            return {"fetched": self.fetched, "bytes": self.bytes}
+
+    def read(self, response, limit, truncate=False):
+        """Body of response, at most limit bytes of it if truncate is set"""
+        length = response.headers.get("Content-Length")
+        if not truncate and length and length.isdigit() and int(length) > limit:
+            raise DocumentError(
+                "Document is {} bytes, more than {}".format(length, limit)
+            )
+        deadline = time.monotonic() + self.read_timeout
+        body = bytearray()
+        while True:
+            # Whatever has arrived, so a slow drip can't outlast the deadline
+            chunk = response.raw.read1(CHUNK_SIZE, decode_content=True)
+            if not chunk:
+                return body
+            body += chunk
+            if len(body) > limit:
+                if truncate:
+                    return body[:limit]
+                raise DocumentError("Document is more than {} bytes".format(limit))
+            if time.monotonic() > deadline:
+                raise DocumentError(
+                    "Document took more than {}s to read".format(self.read_timeout)
+                )
@@ -0,0 +1,331 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from include.checker import Checker
+from include.pool import HttpPool
+from include.ratelimit import RateLimiter, RateLimitedHttp, host_of
+from include.retry import Deadline, RetryPolicy, RetryingHttp
+from include.producers import ProducerJsonIndex
+from include.canonical import HashCache
+from include.breaker import CircuitBreaker
+from include.dns import Resolver
+from include.latency import LatencyRecorder
+from include.metrics import Metrics, stats_collector
+from include.timings import Timings
+
+CONCURRENCY = 64
+PER_HOST_CONCURRENCY = 4
+P2P_CONCURRENCY = 512
+
+
+class Engine:
+    """Runs the checks of every producer of a chain at once
+
+    Each producer still goes through get_bpjson -> get_onchain_bpjson ->
+    probes, but all producers and all of their probes run concurrently on a
+    thread pool, bounded by a global cap and a per-host cap. Probe outcomes
+    are merged back into each Checker in plan order, so the result is the
+    same as calling run_checks on every producer one after the other.
+
+    Probe outcomes depend only on the probe kind and URL, so within a sweep
+    each (kind, url) pair runs once and every producer or node listing it
+    gets the same result. Outside run_async only in-flight probes are
+    shared.
+
+    p2p probes only wait on sockets, so they run on the event loop itself,
+    capped by p2p_concurrency instead of the thread pool.
+
+    Host names are resolved up front, all at once: the producers' own
+    before the bp.json stage, the nodes' ones before their probes.
+
+    The timings of every probe run go to latency until it is drained when
+    the chain is published, and its outcome to metrics. Every call made
+    for a producer is timed under its method name in timings.
+    """
+
+    def __init__(
+        self,
+        chain_info,
+        logging,
+        concurrency=CONCURRENCY,
+        per_host=PER_HOST_CONCURRENCY,
+        p2p_concurrency=P2P_CONCURRENCY,
+        http=None,
+        cache=None,
+        hashes=None,
+        limiter=None,
+        policy=None,
+        breaker=None,
+        resolver=None,
+        documents=None,
+        metrics=None,
+    ):
+        self.chain_info = chain_info
+        self.resolver = resolver or Resolver()
+        self.documents = documents
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter or RateLimiter()
+        self.policy = policy or RetryPolicy()
+        self.http = RetryingHttp(
+            RateLimitedHttp(http or HttpPool(), self.limiter), self.policy
+        )
+        self.cache = cache
+        self.hashes = hashes or HashCache()
+        self.logging = logging
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.p2p_concurrency = p2p_concurrency
+        self.host_limits = {}
+        self.sweep = False
+        self.latency = LatencyRecorder()
+        self.metrics = metrics or Metrics()
+        self.timings = Timings()
+        self.metrics.collect(
+            stats_collector(
+                "nodestatus_retry",
+                self.policy.stats,
+                "Requests sent through the retry policy",
+                ("chain",),
+                (chain_info["name"],),
+            )
+        )
+        self.producerjson = ProducerJsonIndex(
+            chain_info["api_node"], logging, http=self.http
+        )
+
+    def run(self, producers, budget=None):
+        return asyncio.run(self.run_async(producers, budget))
+
+    async def run_async(self, producers, budget=None):
+        """Check all producers, giving up on the ones still running after
+        budget seconds; those are reported by a new checker holding only a
+        time budget error"""
+        self.open()
+        self.sweep = True
+        self.producerjson.expire()
+        sweep = Deadline(budget) if budget is not None else None
+        checkers = [
+            self.checker(producer, Deadline(self.policy.producer_budget, parent=sweep))
+            for producer in producers
+        ]
+        pending = set()
+        try:
+            await self.resolve(
+                url
+                for producer in producers
+                for url in (producer["url"], producer.get("bp_json_url", ""))
+            )
+            tasks = [asyncio.ensure_future(self.check_producer(c)) for c in checkers]
+            if tasks:
+                _, pending = await asyncio.wait(tasks, timeout=budget)
+            for num, task in enumerate(tasks):
+                if task in pending:
+                    task.cancel()
+                    # Its calls still running on the pool keep changing the
+                    # checker; what is published is a fresh one
+                    checker = self.checker(dict(checkers[num].producer_info))
+                    checker.status = 2
+                    msg = "Checks did not finish within the {}s time budget".format(
+                        round(budget)
+                    )
+                    checker.errors.append(msg)
+                    checkers[num] = checker
+                    self.logging.critical(
+                        "{}: {}".format(checker.producer_info["owner"], msg)
+                    )
+            await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            # Threads stuck on a slow host finish on their own timeouts
+            self.close(wait=not pending)
+            self.sweep = False
+            self.save()
+        self.logging.info(
+            "{}: {} probes planned, {} run".format(
+                self.chain_info["name"], self.planned, len(self.probes)
+            )
+        )
+        self.logging.info(
+            "{}: {retries} retries taking {retry_seconds:.1f}s over {requests} "
+            "requests, {failed_fast} failed fast, {deadline_exceeded} past "
+            "their deadline".format(self.chain_info["name"], **self.policy.stats())
+        )
+        self.logging.info(
+            "{}: {open} endpoints open, {failing} failing, {skipped} probes "
+            "skipped".format(self.chain_info["name"], **self.breaker.stats())
+        )
+        self.logging.info(
+            "{}: {hosts} hosts resolved, {lookups} lookups, {hits} cache hits, "
+            "{failures} failed".format(self.chain_info["name"], **self.resolver.stats())
+        )
+        return checkers
+
+    def checker(self, producer, deadline=None):
+        """Checker for producer whose requests all end by deadline, if any"""
+        return Checker(
+            self.chain_info,
+            producer,
+            self.logging,
+            http=self.http.bound(deadline),
+            cache=self.cache,
+            hashes=self.hashes,
+            resolver=self.resolver,
+            documents=self.documents,
+        )
+
+    def save(self):
+        """Persist the bp.json hashes and endpoint breakers"""
+        try:
+            self.hashes.save()
+            self.breaker.save()
+        except OSError as e:
+            self.logging.critical("Error saving engine state: {}".format(e))
+
+    def open(self):
+        self.limit = asyncio.Semaphore(self.concurrency)
+        self.p2p_limit = asyncio.Semaphore(self.p2p_concurrency)
+        self.host_limits = {}
+        self.probes = {}
+        self.planned = 0
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="checker"
+        )
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+    def host_limit(self, host):
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(self.per_host)
+        return self.host_limits[host]
+
+    async def call(self, host, fn, *args, name=None):
+        """fn(*args) on the thread pool, timed as method name, fn's own
+        name by default"""
+        run = self.timings.timed(name or fn.__name__, fn)
+        async with self.host_limit(host):
+            async with self.limit:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, run, *args)
+
+    async def resolve(self, urls):
+        """Look up the hosts of urls not in the resolver's cache, at once"""
+        hosts = {host_of(url) for url in urls} - {""}
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    self.executor,
+                    self.timings.timed("resolve", self.resolver.resolve),
+                    host,
+                )
+                for host in hosts
+                if not self.resolver.cached(host)
+            ]
+        )
+
+    async def prepare(self, checker):
+        """Fetch and validate the producer's bp.json; returns the probe plan,
+        empty if the bp.json stage failed"""
+        timeout = self.chain_info["timeout"]
+        producer = checker.producer_info
+        self.logging.info("Checking producer {}".format(producer["owner"]))
+
+        try:
+            await self.call(
+                host_of(producer["bp_json_url"]), checker.get_bpjson, timeout
+            )
+            if self.chain_info["name"] == "WAX":
+                api_node = host_of(self.chain_info["api_node"])
+                # Scanned once per sweep; None falls back to a lookup per producer
+                checker.onchain_index = await self.call(
+                    api_node, self.producerjson.get, timeout, name="producerjson"
+                )
+                await self.call(api_node, checker.get_onchain_bpjson, timeout)
+            return checker.plan_checks()
+        except Exception as e:
+            self.logging.critical(
+                "Error checking producer {}: {}".format(producer["owner"], e)
+            )
+            return []
+
+    async def probe(self, checker, kind, url):
+        key = (kind, url)
+        self.planned += 1
+        if key not in self.probes:
+            if kind == "p2p":
+                run = self.probe_p2p(checker, url)
+            else:
+                run = self.call(
+                    host_of(url),
+                    self.breaker.guard,
+                    kind,
+                    url,
+                    checker.run_probe,
+                    self.chain_info["timeout"],
+                    name="probe {}".format(kind),
+                )
+            task = asyncio.ensure_future(self.measure(kind, url, run))
+            self.probes[key] = task
+            if not self.sweep:
+                task.add_done_callback(lambda _: self.probes.pop(key, None))
+        result = await self.probes[key]
+        # Once for every producer listing the endpoint, not only the first
+        self.metrics.probe(
+            self.chain_info["name"], checker.producer_info["owner"], result
+        )
+        return result
+
+    async def measure(self, kind, url, run):
+        """Record the timings of a probe run, however many producers share it"""
+        result = await run
+        self.latency.add(url, kind, result.timings)
+        self.metrics.probe_duration(self.chain_info["name"], result)
+        return result
+
+    async def probe_p2p(self, checker, url):
+        """breaker.guard for a p2p probe run on the event loop, its host
+        looked up on the thread pool first so the loop never blocks on DNS,
+        in a sweep or in the daemon, whose probes come one at a time"""
+        timeout = self.chain_info["timeout"]
+        host = host_of(url)
+        loop = asyncio.get_running_loop()
+        replay = await loop.run_in_executor(
+            self.executor, self.breaker.admit, "p2p", url, timeout
+        )
+        if replay is not None:
+            return replay
+        # The probe looks the host up on the loop; off it, unless cached
+        await self.resolve([url])
+        async with self.host_limit(host):
+            async with self.p2p_limit:
+                started = time.monotonic()
+                wait = self.limiter.reserve(host)
+                await asyncio.sleep(wait)
+                result = await checker.run_p2p_probe(url)
+                self.timings.record_method(
+                    "probe p2p",
+                    wall_seconds=time.monotonic() - started,
+                    network_seconds=sum(result.timings.get("total", [])),
+                    sleep_seconds=wait,
+                )
+        await loop.run_in_executor(
+            self.executor, self.breaker.record, "p2p", url, result, timeout
+        )
+        return result
+
+    async def check_producer(self, checker):
+        plan = await self.prepare(checker)
+        await self.resolve(url for _, url in plan)
+        results = await asyncio.gather(
+            *[self.probe(checker, kind, url) for kind, url in plan],
+            return_exceptions=True,
+        )
+        for (kind, url), result in zip(plan, results):
+            if isinstance(result, Exception):
+                self.logging.critical(
+                    "Error running {} check on {}: {}".format(kind, url, result)
+                )
+                continue
+            checker.apply_probe(result)
+            if checker.wrong_chain_id:
+                break
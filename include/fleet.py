@@ -0,0 +1,311 @@
+import datetime
+import json
+import random
+import socket
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from include.p2p import handshake_message
+
+CHAIN_ID = "1064487b3cd1a897ce03ae5b6a865651747e2e152090f99c1d19d44e01aea5a4"
+API_NODE = "127.0.0.1"
+FEATURES = [
+    "chain-api",
+    "account-query",
+    "history-v1",
+    "hyperion-v2",
+    "atomic-assets-api",
+    "ipfs",
+    "light-api",
+]
+HANG = 5
+# Paths injected errors and hangs leave alone, so every sweep plans the same probes
+STABLE_PATHS = ("/bp.json", "/chains.json")
+
+
+def address(num):
+    """Loopback address of producer num; Linux routes all of 127/8 to lo"""
+    return "127.{}.{}.{}".format(num // 62500, num // 250 % 250 + 1, num % 250 + 2)
+
+
+class MockFleet:
+    """Local stand-in for a chain's API node and its producers, to run
+    sweeps against without the internet
+
+    Producer num answers on its own loopback address, see address(), with
+    a bp.json listing one query node with every feature and one p2p seed.
+    The chain API on 127.0.0.1 serves get_producers and the eosio
+    producers and producerjson tables. Every producer request takes
+    latency seconds, and fails with a 500 with probability error_rate or
+    hangs for hang seconds with probability timeout_rate, except the bp.json
+    and chains.json ones. bp.json answers carry an ETag. p2p listeners
+    answer a handshake with one for chain_id. Linux only.
+    """
+
+    def __init__(
+        self,
+        producers=21,
+        latency=0.0,
+        error_rate=0.0,
+        timeout_rate=0.0,
+        hang=HANG,
+        chain_id=CHAIN_ID,
+        seed=1,
+    ):
+        self.producers = producers
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.chain_id = chain_id
+        self.random = random.Random(seed)
+        self.names = ["bp{}".format(num) for num in range(producers)]
+        self.numbers = {name: num for num, name in enumerate(self.names)}
+        self.http = None
+        self.p2p = None
+        self.threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        handler = type("Handler", (FleetHandler,), {"fleet": self})
+        # Bound to every address for 127/8; requests from elsewhere are dropped
+        self.http = FleetServer(("", 0), handler)
+        self.p2p = socket.socket()
+        self.p2p.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.p2p.bind(("", 0))
+        self.p2p.listen(1024)
+        self.port = self.http.server_address[1]
+        self.p2p_port = self.p2p.getsockname()[1]
+        self.threads = [
+            threading.Thread(target=self.http.serve_forever, daemon=True),
+            threading.Thread(target=self.serve_p2p, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.http.shutdown()
+        self.http.server_close()
+        self.p2p.close()
+
+    def chain_info(self, name="WAX", timeout=2):
+        """chain_info for the fleet, as in config.json"""
+        return {
+            "name": name,
+            "chain_id": self.chain_id,
+            "api_node": "http://{}:{}".format(API_NODE, self.port),
+            "testnet": False,
+            "limit": False,
+            "timeout": timeout,
+        }
+
+    def url(self, num):
+        return "http://{}:{}".format(address(num), self.port)
+
+    def bpjson(self, num):
+        return {
+            "producer_account_name": self.names[num],
+            "org": {"candidate_name": "Producer {}".format(num), "github_user": "bp"},
+            "nodes": [
+                {
+                    "node_type": ["query"],
+                    "features": FEATURES,
+                    "api_endpoint": self.url(num),
+                    "ssl_endpoint": self.url(num) + "/",
+                },
+                {
+                    "node_type": "seed",
+                    "p2p_endpoint": "{}:{}".format(address(num), self.p2p_port),
+                },
+            ],
+        }
+
+    def producer_rows(self, lower_bound, limit, upper_bound=None):
+        """Rows from lower_bound on, and the name of the next one if any"""
+        names = [name for name in self.names if name >= (lower_bound or "")]
+        if upper_bound:
+            names = [name for name in names if name <= upper_bound]
+        return names[:limit], names[limit] if len(names) > limit else ""
+
+    def serve_p2p(self):
+        while True:
+            try:
+                connection, _ = self.p2p.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self.handshake, args=(connection,), daemon=True
+            ).start()
+
+    def handshake(self, connection):
+        try:
+            connection.settimeout(self.hang)
+            connection.recv(4096)
+            time.sleep(self.latency)
+            connection.sendall(handshake_message(self.chain_id))
+            connection.recv(1)
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+
+class FleetServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on hanging requests; that is the point of them
+        pass
+
+
+class FleetHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fleet = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.route({})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.route(json.loads(self.rfile.read(length) or b"{}"))
+
+    def route(self, body):
+        if not self.client_address[0].startswith("127."):
+            self.close_connection = True
+            return
+        fleet = self.fleet
+        host = self.headers.get("Host", API_NODE).rsplit(":", 1)[0]
+        path = self.path
+        if host == API_NODE:
+            return self.chain_api(path, body)
+
+        time.sleep(fleet.latency)
+        num = self.producer(host)
+        if num is None:
+            return self.send(404, {})
+        if path not in STABLE_PATHS:
+            roll = fleet.random.random()
+            if roll < fleet.error_rate:
+                return self.send(500, {"error": "Injected error"})
+            if roll < fleet.error_rate + fleet.timeout_rate:
+                time.sleep(fleet.hang)
+
+        now = datetime.datetime.utcnow().isoformat(timespec="milliseconds")
+        if path == "/chains.json":
+            return self.send(200, {"chains": {fleet.chain_id: "/bp.json"}})
+        if path == "/bp.json":
+            return self.send(200, fleet.bpjson(num), etag=True)
+        if path.endswith("/v1/chain/get_info"):
+            return self.send(200, {"chain_id": fleet.chain_id, "head_block_time": now})
+        if path.endswith("/v1/chain/get_accounts_by_authorizers"):
+            return self.send(200, {"accounts": []})
+        if path.endswith("/v1/history/get_actions"):
+            return self.send(200, {"actions": [{"block_time": now}]})
+        if "/v2/history/get_actions" in path:
+            return self.send(200, {"actions": [{"timestamp": now}]})
+        if path.endswith("/v2/health"):
+            return self.send(
+                200,
+                {
+                    "health": [
+                        {
+                            "service": "Elasticsearch",
+                            "status": "OK",
+                            "service_data": {"missing_blocks": 0},
+                        }
+                    ]
+                },
+            )
+        if path.endswith("/health"):
+            return self.send(
+                200,
+                {
+                    "data": {
+                        "chain": {"head_block": 100},
+                        "postgres": {"readers": [{"block_num": 100}]},
+                    }
+                },
+            )
+        if path.startswith("/ipfs/") or path.endswith("/api/status"):
+            return self.send(200, {})
+        return self.send(404, {})
+
+    def chain_api(self, path, body):
+        fleet = self.fleet
+        limit = int(body.get("limit", 10))
+        if path == "/v1/chain/get_producers":
+            names, more = fleet.producer_rows(body.get("lower_bound"), limit)
+            rows = [
+                {
+                    "owner": name,
+                    "url": fleet.url(fleet.numbers[name]),
+                    "is_active": 1,
+                    "total_votes": str(fleet.producers - fleet.numbers[name]),
+                }
+                for name in names
+            ]
+            return self.send(
+                200, {"rows": rows, "more": more, "total_producer_vote_weight": "1"}
+            )
+        if path == "/v1/chain/get_table_rows":
+            names, more = fleet.producer_rows(
+                body.get("lower_bound"), limit, body.get("upper_bound")
+            )
+            if body.get("table") == "producerjson":
+                rows = [
+                    {
+                        "data": {
+                            "owner": name,
+                            "json": json.dumps(fleet.bpjson(fleet.numbers[name])),
+                        },
+                        "payer": name,
+                    }
+                    for name in names
+                ]
+            else:
+                rows = [
+                    {
+                        "owner": name,
+                        "url": fleet.url(fleet.numbers[name]),
+                        "is_active": 1,
+                        "total_votes": str(fleet.producers - fleet.numbers[name]),
+                    }
+                    for name in names
+                ]
+            return self.send(200, {"rows": rows, "more": bool(more), "next_key": more})
+        return self.send(404, {})
+
+    def producer(self, host):
+        parts = host.split(".")
+        if len(parts) != 4 or parts[0] != "127":
+            return None
+        num = int(parts[1]) * 62500 + (int(parts[2]) - 1) * 250 + int(parts[3]) - 2
+        return num if 0 <= num < self.fleet.producers else None
+
+    def send(self, status, data, etag=False):
+        body = json.dumps(data).encode()
+        headers = {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Origin": "*",
+        }
+        if etag:
+            headers["ETag"] = '"{:08x}"'.format(zlib.crc32(body))
+            if self.headers.get("If-None-Match") == headers["ETag"]:
+                status, body = 304, b""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,390 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from include.latency import Histogram, METRICS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS producers (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS endpoints (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS bpjson (
+    hash TEXT PRIMARY KEY,
+    content TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    chain_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    last_update TEXT,
+    last_update_iso TEXT,
+    healthy TEXT NOT NULL,
+    extra TEXT NOT NULL,
+    UNIQUE (chain_id, date)
+);
+CREATE TABLE IF NOT EXISTS producer_status (
+    snapshot_id INTEGER NOT NULL,
+    producer_id INTEGER NOT NULL,
+    ord INTEGER NOT NULL,
+    position INTEGER,
+    status INTEGER,
+    org_name,
+    bpjson_hash TEXT,
+    history INTEGER,
+    hyperion INTEGER,
+    atomic INTEGER,
+    lightapi INTEGER,
+    errors TEXT NOT NULL,
+    oks TEXT NOT NULL,
+    warnings TEXT NOT NULL,
+    endpoints TEXT NOT NULL,
+    bp_json TEXT,
+    onchain_bp_json INTEGER,
+    extra TEXT NOT NULL,
+    PRIMARY KEY (snapshot_id, producer_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS endpoint_status (
+    snapshot_id INTEGER NOT NULL,
+    producer_id INTEGER NOT NULL,
+    endpoint_id INTEGER NOT NULL,
+    ord INTEGER NOT NULL,
+    errors TEXT NOT NULL,
+    oks TEXT NOT NULL,
+    PRIMARY KEY (snapshot_id, producer_id, endpoint_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS latency (
+    chain_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    endpoint_id INTEGER NOT NULL,
+    histograms TEXT NOT NULL,
+    PRIMARY KEY (chain_id, date, endpoint_id)
+) WITHOUT ROWID;
+"""
+
+PRODUCER_COLUMNS = [
+    "position",
+    "status",
+    "org_name",
+    "history",
+    "hyperion",
+    "atomic",
+    "lightapi",
+    "bp_json",
+    "onchain_bp_json",
+]
+BOOLEAN_COLUMNS = ["onchain_bp_json"]
+PRODUCER_KEYS = PRODUCER_COLUMNS + [
+    "account",
+    "bp_json_content",
+    "errors",
+    "oks",
+    "warnings",
+    "endpoints",
+    "endpoint_errors",
+    "endpoint_oks",
+]
+
+
+def packed(ids):
+    return ",".join(map(str, ids))
+
+
+def unpacked(text):
+    return [int(i) for i in text.split(",")] if text else []
+
+
+class HistoryStore:
+    """Daily per-chain status history in SQLite
+
+    One snapshot per chain and day, like pub/<chain_id>-<date>.json, but
+    stored as one row per producer and one row per endpoint. Producer
+    names, endpoint URLs and error/ok messages are dictionary-encoded,
+    and bp.json documents are stored once per content hash. snapshot()
+    and query() return the same dicts that were published.
+
+    Latency histograms are kept per chain, day and endpoint, each day's
+    adding up the samples of every run that day.
+
+    The store is the only copy of past days unless daily_snapshots is set,
+    which also writes every day's pub/<chain_id>-<date>.json file.
+    """
+
+    def __init__(self, path, daily_snapshots=False):
+        self.daily_snapshots = daily_snapshots
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.ids = {"producers": {}, "endpoints": {}, "messages": {}}
+        self.values = {"producers": {}, "endpoints": {}, "messages": {}}
+
+    @classmethod
+    def from_config(cls, CONFIG, base_path):
+        settings = CONFIG.get("history", {})
+        return cls(
+            os.path.join(base_path, settings.get("path", "history.db")),
+            daily_snapshots=settings.get("daily_snapshots", False),
+        )
+
+    def close(self):
+        self.db.close()
+
+    def id(self, table, value):
+        ids = self.ids[table]
+        if value not in ids:
+            column = "name" if table == "producers" else "url"
+            column = "text" if table == "messages" else column
+            self.db.execute(
+                f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", (value,)
+            )
+            ids[value] = self.db.execute(
+                f"SELECT id FROM {table} WHERE {column} = ?", (value,)
+            ).fetchone()[0]
+        return ids[value]
+
+    def value(self, table, id):
+        values = self.values[table]
+        if id not in values:
+            for row in self.db.execute(f"SELECT * FROM {table}"):
+                values[row[0]] = row[1]
+        return values[id]
+
+    def messages(self, texts):
+        return packed(self.id("messages", text) for text in texts)
+
+    def record(self, chain_id, date, data):
+        """Store data as the snapshot of chain_id for date, replacing any
+        earlier snapshot of the same day"""
+        with self.lock, self.db:
+            self.delete(chain_id, date)
+            healthy = {
+                key: packed(self.id("endpoints", url) for url in value)
+                for key, value in data.items()
+                if key.startswith("healthy_")
+            }
+            extra = {
+                key: value
+                for key, value in data.items()
+                if not key.startswith("healthy_")
+                and key not in ("producers", "last_update", "last_update_iso")
+            }
+            snapshot_id = self.db.execute(
+                "INSERT INTO snapshots "
+                "(chain_id, date, last_update, last_update_iso, healthy, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    chain_id,
+                    date,
+                    data.get("last_update"),
+                    data.get("last_update_iso"),
+                    json.dumps(healthy),
+                    json.dumps(extra),
+                ),
+            ).lastrowid
+
+            for ord, producer in enumerate(data["producers"]):
+                self.record_producer(snapshot_id, ord, producer)
+
+    def record_producer(self, snapshot_id, ord, producer):
+        producer_id = self.id("producers", producer["account"])
+        bpjson_hash = None
+        if producer.get("bp_json_content") is not None:
+            content = json.dumps(
+                producer["bp_json_content"], sort_keys=True, separators=(",", ":")
+            )
+            bpjson_hash = hashlib.sha256(content.encode()).hexdigest()
+            self.db.execute(
+                "INSERT OR IGNORE INTO bpjson (hash, content) VALUES (?, ?)",
+                (bpjson_hash, content),
+            )
+        extra = {k: v for k, v in producer.items() if k not in PRODUCER_KEYS}
+        columns = []
+        for column in PRODUCER_COLUMNS:
+            value = producer.get(column)
+            if column in BOOLEAN_COLUMNS and isinstance(value, bool):
+                value = int(value)
+            elif type(value) not in (str, int, float, type(None)):
+                # Whatever a bp.json puts in e.g. candidate_name, kept as is
+                extra[column] = value
+                value = None
+            columns.append(value)
+        self.db.execute(
+            "INSERT INTO producer_status (snapshot_id, producer_id, ord, "
+            "bpjson_hash, errors, oks, warnings, endpoints, extra, {}) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, {})".format(
+                ", ".join(PRODUCER_COLUMNS), ", ".join("?" * len(PRODUCER_COLUMNS))
+            ),
+            [
+                snapshot_id,
+                producer_id,
+                ord,
+                bpjson_hash,
+                self.messages(producer["errors"]),
+                self.messages(producer["oks"]),
+                self.messages(producer["warnings"]),
+                packed(self.id("endpoints", url) for url in producer["endpoints"]),
+                json.dumps(extra),
+            ]
+            + columns,
+        )
+        self.db.executemany(
+            "INSERT INTO endpoint_status "
+            "(snapshot_id, producer_id, endpoint_id, ord, errors, oks) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    snapshot_id,
+                    producer_id,
+                    self.id("endpoints", url),
+                    ord,
+                    self.messages(errors),
+                    self.messages(producer["endpoint_oks"].get(url, [])),
+                )
+                for ord, (url, errors) in enumerate(producer["endpoint_errors"].items())
+            ],
+        )
+
+    def delete(self, chain_id, date):
+        row = self.db.execute(
+            "SELECT id FROM snapshots WHERE chain_id = ? AND date = ?",
+            (chain_id, date),
+        ).fetchone()
+        if row:
+            for table in ("endpoint_status", "producer_status"):
+                self.db.execute(f"DELETE FROM {table} WHERE snapshot_id = ?", row)
+            self.db.execute("DELETE FROM snapshots WHERE id = ?", row)
+
+    def record_latency(self, chain_id, date, endpoints):
+        """Add {url: {kind: {metric: Histogram}}} to the histograms of date"""
+        with self.lock, self.db:
+            for url, kinds in endpoints.items():
+                key = (chain_id, date, self.id("endpoints", url))
+                row = self.db.execute(
+                    "SELECT histograms FROM latency "
+                    "WHERE chain_id = ? AND date = ? AND endpoint_id = ?",
+                    key,
+                ).fetchone()
+                stored = by_kind(json.loads(row[0])) if row else {}
+                for kind, histograms in kinds.items():
+                    stored_kind = stored.setdefault(kind, {})
+                    for metric, histogram in histograms.items():
+                        merged = Histogram.from_dict(stored_kind.get(metric, {}))
+                        merged.merge(histogram)
+                        stored_kind[metric] = merged.to_dict()
+                self.db.execute(
+                    "INSERT OR REPLACE INTO latency "
+                    "(chain_id, date, endpoint_id, histograms) VALUES (?, ?, ?, ?)",
+                    key + (json.dumps(stored, separators=(",", ":")),),
+                )
+
+    def latency(self, chain_id, start=None):
+        """{url: {kind: {metric: Histogram}}} over the days since start,
+        inclusive"""
+        endpoints = {}
+        with self.lock:
+            for endpoint_id, stored in self.db.execute(
+                "SELECT endpoint_id, histograms FROM latency "
+                "WHERE chain_id = ? AND date >= ?",
+                (chain_id, start or ""),
+            ):
+                kinds = endpoints.setdefault(self.value("endpoints", endpoint_id), {})
+                for kind, metrics in by_kind(json.loads(stored)).items():
+                    histograms = kinds.setdefault(kind, {})
+                    for metric, counts in metrics.items():
+                        histogram = histograms.setdefault(metric, Histogram())
+                        histogram.merge(Histogram.from_dict(counts))
+        return endpoints
+
+    def dates(self, chain_id):
+        with self.lock:
+            return [
+                date
+                for (date,) in self.db.execute(
+                    "SELECT date FROM snapshots WHERE chain_id = ? ORDER BY date",
+                    (chain_id,),
+                )
+            ]
+
+    def snapshot(self, chain_id, date):
+        return self.query(chain_id, date, date).get(date)
+
+    def query(self, chain_id, start=None, end=None):
+        """{date: data} for the snapshots of chain_id between start and end,
+        both inclusive ISO dates"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, date, last_update, last_update_iso, healthy, extra "
+                "FROM snapshots WHERE chain_id = ? AND date >= ? AND date <= ? "
+                "ORDER BY date",
+                (chain_id, start or "", end or "9999"),
+            ).fetchall()
+            return {row[1]: self.load(*row) for row in rows}
+
+    def load(self, snapshot_id, date, last_update, last_update_iso, healthy, extra):
+        endpoints = {}
+        for producer_id, endpoint_id, errors, oks in self.db.execute(
+            "SELECT producer_id, endpoint_id, errors, oks FROM endpoint_status "
+            "WHERE snapshot_id = ? ORDER BY producer_id, ord",
+            (snapshot_id,),
+        ):
+            url = self.value("endpoints", endpoint_id)
+            item = endpoints.setdefault(producer_id, ({}, {}))
+            item[0][url] = [self.value("messages", i) for i in unpacked(errors)]
+            item[1][url] = [self.value("messages", i) for i in unpacked(oks)]
+
+        producers = []
+        for row in self.db.execute(
+            "SELECT producer_id, errors, oks, warnings, endpoints, extra, "
+            "bpjson.content, {} FROM producer_status "
+            "LEFT JOIN bpjson ON bpjson.hash = producer_status.bpjson_hash "
+            "WHERE snapshot_id = ? ORDER BY ord".format(", ".join(PRODUCER_COLUMNS)),
+            (snapshot_id,),
+        ):
+            producer_id, errors, oks, warnings, urls, producer_extra, content = row[:7]
+            producer = dict(zip(PRODUCER_COLUMNS, row[7:]))
+            for column in BOOLEAN_COLUMNS:
+                if producer[column] is not None:
+                    producer[column] = bool(producer[column])
+            endpoint_errors, endpoint_oks = endpoints.get(producer_id, ({}, {}))
+            producer.update(
+                {
+                    "account": self.value("producers", producer_id),
+                    "bp_json_content": None if content is None else json.loads(content),
+                    "errors": [self.value("messages", i) for i in unpacked(errors)],
+                    "oks": [self.value("messages", i) for i in unpacked(oks)],
+                    "warnings": [self.value("messages", i) for i in unpacked(warnings)],
+                    "endpoints": [self.value("endpoints", i) for i in unpacked(urls)],
+                    "endpoint_errors": endpoint_errors,
+                    "endpoint_oks": endpoint_oks,
+                }
+            )
+            producer.update(json.loads(producer_extra))
+            producers.append(producer)
+
+        data = {
+            "producers": producers,
+            "last_update": last_update,
+            "last_update_iso": last_update_iso,
+        }
+        for key, ids in json.loads(healthy).items():
+            data[key] = [self.value("endpoints", i) for i in unpacked(ids)]
+        data.update(json.loads(extra))
+        return data
+
+
+def by_kind(stored):
+    """Stored latency histograms by probe kind; rows written before they
+    were kept per kind mix every kind and are left out"""
+    if any(metric in stored for metric in METRICS):
+        return {}
+    return stored
@@ -0,0 +1,120 @@
+import math
+import threading
+
+# Bucket bounds grow by 10%, so percentiles are within 10% of the truth
+BASE = 1.1
+METRICS = ["dns", "connect", "tls", "ttfb", "total"]
+PERCENTILES = {"p50": 0.5, "p95": 0.95}
+
+local = threading.local()
+
+
+class Histogram:
+    """Log-bucketed histogram of latencies in milliseconds
+
+    Bucket 0 holds everything under 1ms and bucket b > 0 the values in
+    [BASE^(b-1), BASE^b), so a day of samples of one endpoint fits in a
+    few dozen counters whatever the number of samples. Histograms merge
+    by adding counts.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = counts or {}
+
+    def add(self, seconds, count=1):
+        ms = seconds * 1000
+        bucket = 0 if ms < 1 else int(math.log(ms, BASE)) + 1
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def percentile(self, q):
+        """Upper bound in ms of the bucket holding the q-th quantile"""
+        rank = q * self.total()
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return round(BASE**bucket, 1)
+        return None
+
+    def to_dict(self):
+        return {str(bucket): count for bucket, count in sorted(self.counts.items())}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls({int(bucket): count for bucket, count in data.items()})
+
+
+def record():
+    """Start collecting the timings of this thread's requests; returns the
+    {metric: [seconds]} dict they go to"""
+    local.timings = {}
+    return local.timings
+
+
+def stop():
+    local.timings = None
+
+
+def mark(metric, seconds):
+    """Add a timing to what the current thread is collecting, if anything"""
+    timings = getattr(local, "timings", None)
+    if timings is not None:
+        timings.setdefault(metric, []).append(seconds)
+
+
+class LatencyRecorder:
+    """Histograms per endpoint, probe kind and metric of the probes run
+    since the last drain(); an endpoint's api and history probes ask for
+    different work, so each kind keeps its own"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def add(self, url, kind, timings):
+        if not timings:
+            return
+        with self.lock:
+            kinds = self.endpoints.setdefault(url, {})
+            histograms = kinds.setdefault(kind, {})
+            for metric, samples in timings.items():
+                histogram = histograms.setdefault(metric, Histogram())
+                for seconds in samples:
+                    histogram.add(seconds)
+
+    def drain(self):
+        """{url: {kind: {metric: Histogram}}}"""
+        with self.lock:
+            endpoints, self.endpoints = self.endpoints, {}
+            return endpoints
+
+
+def summary(histograms):
+    """{metric: {"p50": ms, "p95": ms}} plus the number of requests"""
+    summary = {}
+    for metric in METRICS:
+        histogram = histograms.get(metric)
+        if histogram is not None and histogram.total():
+            summary[metric] = {
+                name: histogram.percentile(q) for name, q in PERCENTILES.items()
+            }
+    if "total" in histograms:
+        summary["samples"] = histograms["total"].total()
+    return summary
+
+
+def fastest(urls, latency, kind="api"):
+    """urls with a known latency by the median time to first byte of their
+    kind probes, fastest first, followed by the others in their original
+    order"""
+    known = [url for url in urls if "ttfb" in latency.get(url, {}).get(kind, {})]
+    known.sort(key=lambda url: latency[url][kind]["ttfb"]["p50"])
+    ranked = set(known)
+    return known + [url for url in urls if url not in ranked]
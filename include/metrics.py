@@ -0,0 +1,220 @@
+import bisect
+import threading
+from include.output import write_file
+
+# Seconds, from a fast local probe to a whole sweep
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# First match wins, on the lowercased message
+ERROR_CLASSES = [
+    ("not probed", "skipped"),
+    ("dns lookup failed", "dns"),
+    ("nameresolutionerror", "dns"),
+    ("timeout", "timeout"),
+    ("timed out", "timeout"),
+    ("time budget", "timeout"),
+    ("no message within", "timeout"),
+    ("certificate", "tls"),
+    ("ssl", "tls"),
+    ("connection refused", "refused"),
+    ("wrong chain", "wrong_chain"),
+    ("another chain", "wrong_chain"),
+    ("peer is on chain", "wrong_chain"),
+    ("error connecting", "connection"),
+    ("max retries exceeded", "connection"),
+    ("cors", "cors"),
+    (" ago", "stale"),
+]
+
+
+def error_class(message):
+    """Kind of failure a probe error message reports, "check" for a node
+    that answered but failed the check"""
+    message = message.lower()
+    for needle, name in ERROR_CLASSES:
+        if needle in message:
+            return name
+    return "check"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    """Counters and histograms in the Prometheus text exposition format
+
+    Metrics are declared once with their label names; recording a sample
+    is a dict lookup and an addition under a lock. Collectors are
+    callables run at render() time that turn the counters other objects
+    already keep (see their stats()) into samples, so those cost nothing
+    on the hot path. The text goes to path after every publish, for
+    node_exporter's textfile collector, and to /metrics with --serve.
+    """
+
+    def __init__(self, path=None, producer_labels=True, buckets=BUCKETS):
+        self.path = path
+        self.producer_labels = producer_labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.samples = {}
+        self.collectors = []
+        self.counter(
+            "nodestatus_probes_total",
+            "Probes run, by outcome: ok or the class of the first error",
+            ("chain", "producer", "kind", "result"),
+        )
+        self.histogram(
+            "nodestatus_probe_duration_seconds",
+            "Time a probe spent in requests, retries included",
+            ("chain", "kind"),
+        )
+        self.histogram(
+            "nodestatus_sweep_duration_seconds",
+            "Time checking and publishing a chain took, in one-shot runs; "
+            "the daemon has no sweeps",
+            ("chain",),
+        )
+        self.counter(
+            "nodestatus_publishes_total", "Times a chain was published", ("chain",)
+        )
+
+    @classmethod
+    def from_config(cls, CONFIG, base_path):
+        settings = CONFIG.get("metrics", {})
+        path = settings.get("path", "metrics.prom")
+        return cls(
+            path=path and "{}/{}".format(base_path, path),
+            producer_labels=settings.get("producer_labels", True),
+        )
+
+    def counter(self, name, help, labels):
+        self.metrics[name] = ("counter", help, labels)
+
+    def histogram(self, name, help, labels):
+        self.metrics[name] = ("histogram", help, labels)
+
+    def inc(self, name, *labels, value=1):
+        key = (name, labels)
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + value
+
+    def observe(self, name, *labels, value):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.samples.get(key)
+            if histogram is None:
+                histogram = self.samples[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def probe(self, chain, producer, result):
+        """Record the outcome of a ProbeResult for a producer it was run for"""
+        outcome = error_class(result.errors[0]) if result.errors else "ok"
+        if not self.producer_labels:
+            producer = ""
+        self.inc("nodestatus_probes_total", chain, producer, result.kind, outcome)
+
+    def probe_duration(self, chain, result):
+        """Record the time a ProbeResult took, once per probe run"""
+        seconds = sum(result.timings.get("total", []))
+        if seconds:
+            self.observe(
+                "nodestatus_probe_duration_seconds", chain, result.kind, value=seconds
+            )
+
+    def collect(self, collector):
+        """Add collector() -> [(name, type, help, labels, [(values, value)])]"""
+        self.collectors.append(collector)
+
+    def render(self):
+        with self.lock:
+            samples = {}
+            for (name, labels), value in self.samples.items():
+                if isinstance(value, Histogram):
+                    value = (list(value.counts), value.sum)
+                samples.setdefault(name, []).append((labels, value))
+        families = [
+            (name, kind, help, labels, sorted(samples.get(name, [])))
+            for name, (kind, help, labels) in self.metrics.items()
+        ]
+        for collector in self.collectors:
+            families += collector()
+        # Collectors of each chain report under the same names
+        merged = {}
+        for name, kind, help, labels, values in families:
+            if name in merged:
+                merged[name][3].extend(values)
+            else:
+                merged[name] = (kind, help, labels, list(values))
+
+        lines = []
+        for name, (kind, help, labels, values) in merged.items():
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for values_, value in values:
+                pairs = list(zip(labels, values_))
+                if kind == "histogram":
+                    lines += histogram_lines(name, pairs, value, self.buckets)
+                else:
+                    lines.append(
+                        "{}{} {}".format(name, label_text(pairs), number(value))
+                    )
+        return ("\n".join(lines) + "\n").encode()
+
+    def write(self):
+        if self.path:
+            write_file(self.path, self.render(), fsync=False)
+
+
+def histogram_lines(name, pairs, value, buckets):
+    counts, total = value
+    lines = []
+    seen = 0
+    for bound, count in zip(list(buckets) + ["+Inf"], counts):
+        seen += count
+        le = pairs + [("le", bound if bound == "+Inf" else number(bound))]
+        lines.append("{}_bucket{} {}".format(name, label_text(le), seen))
+    lines.append("{}_sum{} {}".format(name, label_text(pairs), number(total)))
+    lines.append("{}_count{} {}".format(name, label_text(pairs), seen))
+    return lines
+
+
+def label_text(pairs):
+    if not pairs:
+        return ""
+    return "{{{}}}".format(
+        ",".join('{}="{}"'.format(label, escape(value)) for label, value in pairs)
+    )
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def number(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def stats_collector(prefix, stats, help, labels=(), values=(), gauges=()):
+    """Collector exposing each number stats() returns as a counter
+    prefix_<key>_total, or as a gauge prefix_<key> for keys in gauges"""
+
+    def collect():
+        families = []
+        for key, value in sorted(stats().items()):
+            kind = "gauge" if key in gauges else "counter"
+            name = "{}_{}{}".format(prefix, key, "" if key in gauges else "_total")
+            description = "{}: {}".format(help, key.replace("_", " "))
+            families.append((name, kind, description, labels, [(values, value)]))
+        return families
+
+    return collect
@@ -0,0 +1,195 @@
+import functools
+import gzip
+import json
+import os
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# What json.dump(data, fp, sort_keys=True, indent=4) always wrote
+INDENT = 4
+ENSURE_ASCII = True
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def dumps_json(data, indent=None, ensure_ascii=False):
+    """data as UTF-8 JSON with sorted keys, compact when indent is None,
+    non-ASCII characters escaped with ensure_ascii"""
+    separators = (",", ":") if indent is None else (",", ": ")
+    return json.dumps(
+        data,
+        sort_keys=True,
+        indent=indent,
+        separators=separators,
+        ensure_ascii=ensure_ascii,
+    ).encode()
+
+
+def dumps_orjson(data, indent=None, ensure_ascii=False):
+    """dumps_json through orjson, which only indents by 2 and never
+    escapes; the same bytes for anything orjson can encode, dumps_json for
+    the rest"""
+    if indent not in (None, 2) or ensure_ascii:
+        return dumps_json(data, indent, ensure_ascii)
+    option = orjson.OPT_SORT_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+    try:
+        return orjson.dumps(data, option=option)
+    except TypeError:
+        # e.g. integers over 64 bits in a bp.json
+        return dumps_json(data, indent)
+
+
+SERIALIZERS = {"json": dumps_json}
+if orjson is not None:
+    SERIALIZERS["orjson"] = dumps_orjson
+
+
+def serializer(name="auto"):
+    """The dumps function called name; "auto" is the fastest installed"""
+    if name == "auto":
+        return SERIALIZERS.get("orjson", dumps_json)
+    if name not in SERIALIZERS:
+        raise ValueError("JSON serializer {} is not available".format(name))
+    return SERIALIZERS[name]
+
+
+dumps = serializer()
+
+
+def temporary(path):
+    return "{}.{}.tmp".format(path, threading.get_ident())
+
+
+def write_file(path, content, fsync=True):
+    """Replace path with content at once: readers get either the old file
+    or the new one, never part of it"""
+    tmp = temporary(path)
+    with open(tmp, "wb") as fp:
+        fp.write(content)
+        if fsync:
+            fp.flush()
+            os.fsync(fp.fileno())
+    os.replace(tmp, path)
+
+
+def link_file(source, path, content, fsync=True):
+    """Replace path with a hard link to source, or with content where the
+    filesystem can't link them"""
+    tmp = temporary(path)
+    try:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.link(source, tmp)
+    except OSError:
+        write_file(path, content, fsync)
+        return
+    os.replace(tmp, path)
+
+
+def sync_directory(path):
+    """Make the renames in directory path durable"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Publisher:
+    """Writes the JSON files under pub/ and their variants
+
+    Each document is serialized once with indent and written to a
+    temporary file, fsynced when fsync is set, and renamed over the
+    published one, so readers never see it half-written. Other paths it is
+    published under are hard links to the same file. Alongside <name>.json,
+    compact writes <name>.min.json, and compress writes <name>.json.gz and,
+    with the brotli module installed, <name>.json.br holding the compact
+    form, for a static server to send as they are.
+
+    By default <name>.json keeps its original format, indented by 4 with
+    non-ASCII characters escaped, which only the json module writes; an
+    indent of 2 and ensure_ascii off let orjson write it several times
+    faster. The compact form is new, so it is always UTF-8 from orjson.
+    """
+
+    def __init__(
+        self,
+        serializer_name="auto",
+        indent=INDENT,
+        compact=True,
+        compress=True,
+        gzip_level=GZIP_LEVEL,
+        brotli_quality=BROTLI_QUALITY,
+        fsync=True,
+        ensure_ascii=ENSURE_ASCII,
+    ):
+        self.serialize = serializer(serializer_name)
+        self.dumps = functools.partial(self.serialize, ensure_ascii=ensure_ascii)
+        self.ensure_ascii = ensure_ascii
+        self.fsync = fsync
+        self.indent = indent
+        self.compact = compact
+        self.compress = compress
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    @classmethod
+    def from_config(cls, CONFIG, logging):
+        settings = CONFIG.get("output", {})
+        if settings.get("compress", True) and brotli is None:
+            logging.warning("brotli module not installed, .json.br files not written")
+        return cls(
+            serializer_name=settings.get("serializer", "auto"),
+            indent=settings.get("indent", INDENT),
+            compact=settings.get("compact", True),
+            compress=settings.get("compress", True),
+            gzip_level=settings.get("gzip_level", GZIP_LEVEL),
+            brotli_quality=settings.get("brotli_quality", BROTLI_QUALITY),
+            fsync=settings.get("fsync", True),
+            ensure_ascii=settings.get("ensure_ascii", ENSURE_ASCII),
+        )
+
+    def publish(self, data, path, *copies):
+        """Write data to path and its variants, and link every copy to it"""
+        content = self.dumps(data, self.indent)
+        write_file(path, content, self.fsync)
+        for copy in copies:
+            link_file(path, copy, content, self.fsync)
+        if self.compact or self.compress:
+            if self.indent is None and not self.ensure_ascii:
+                compact = content
+            else:
+                compact = self.serialize(data)
+            self.variants(path, compact)
+        if self.fsync:
+            sync_directory(os.path.dirname(path) or ".")
+
+    def variants(self, path, compact):
+        """Write the compact and compressed variants of path"""
+        if self.compact:
+            write_file(path[: -len(".json")] + ".min.json", compact, self.fsync)
+        self.compressed(path, compact)
+
+    def compressed(self, path, content):
+        """Write content compressed next to path, if compress is set"""
+        if self.compress:
+            write_file(
+                path + ".gz",
+                gzip.compress(content, self.gzip_level, mtime=0),
+                self.fsync,
+            )
+            if brotli is not None:
+                write_file(
+                    path + ".br",
+                    brotli.compress(content, quality=self.brotli_quality),
+                    self.fsync,
+                )
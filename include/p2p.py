@@ -0,0 +1,126 @@
+import asyncio
+import os
+import struct
+import time
+
+NETWORK_VERSION = 1206
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# net_message variant of nodeos' net_plugin, in index order
+MESSAGES = [
+    "handshake",
+    "chain_size",
+    "go_away",
+    "time",
+    "notice",
+    "request",
+    "sync_request",
+    "signed_block",
+    "packed_transaction",
+    "vote",
+]
+HANDSHAKE = MESSAGES.index("handshake")
+# go_away_reason
+WRONG_CHAIN = 3
+
+
+class P2PError(Exception):
+    """The peer answered, but not like a nodeos p2p listener would"""
+
+
+def varuint(value):
+    out = b""
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out += bytes([byte | 0x80])
+        else:
+            return out + bytes([byte])
+
+
+def string(value):
+    data = value.encode()
+    return varuint(len(data)) + data
+
+
+def handshake_message(chain_id):
+    """Framed handshake_message for chain_id with an empty key and
+    signature, which nodes accepting any peer answer with their own"""
+    now = time.time_ns()
+    payload = (
+        struct.pack("<H", NETWORK_VERSION)
+        + bytes.fromhex(chain_id)
+        + os.urandom(32)  # node_id, must not be the peer's own
+        + varuint(0)
+        + bytes(33)  # empty K1 public key
+        + struct.pack("<q", now)
+        + bytes(32)  # token
+        + varuint(0)
+        + bytes(65)  # empty K1 signature
+        + string("nodestatus:0 - probe")
+        + struct.pack("<I", 0)
+        + bytes(32)  # last irreversible block id
+        + struct.pack("<I", 0)
+        + bytes(32)  # head block id
+        + string("linux")
+        + string('"nodestatus"')
+        + struct.pack("<h", 1)
+    )
+    message = varuint(HANDSHAKE) + payload
+    return struct.pack("<I", len(message)) + message
+
+
+async def read_message(reader):
+    """Type and the start of the payload of the next message"""
+    size = struct.unpack("<I", await reader.readexactly(4))[0]
+    if size == 0 or size > MAX_MESSAGE_SIZE:
+        raise P2PError("Invalid message size {}".format(size))
+    kind = (await reader.readexactly(1))[0]
+    if kind >= len(MESSAGES):
+        raise P2PError("Unknown message type {}".format(kind))
+    # Handshakes are a few hundred bytes; only their chain id is needed
+    payload = await reader.read(min(size - 1, 64))
+    return MESSAGES[kind], payload
+
+
+async def probe(host, port, chain_id, timeout):
+    """Connect to a p2p listener, send it a handshake and wait for its
+    first message
+
+    Returns the connect and handshake latencies in seconds and the type of
+    the message. Raises OSError if the connection fails,
+    asyncio.TimeoutError if it takes longer than timeout and P2PError if
+    no answer comes in time, or it isn't nodeos' or is for another chain.
+    """
+    started = time.monotonic()
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port), timeout
+    )
+    connected = time.monotonic()
+    try:
+        writer.write(handshake_message(chain_id))
+        await writer.drain()
+        try:
+            kind, payload = await asyncio.wait_for(read_message(reader), timeout)
+        except asyncio.IncompleteReadError:
+            raise P2PError("Connection closed before any message")
+        except asyncio.TimeoutError:
+            raise P2PError("No message within {}s of the handshake".format(timeout))
+        handshake = time.monotonic()
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    if kind == "handshake" and len(payload) >= 34 and payload[2:34].hex() != chain_id:
+        raise P2PError("Peer is on chain {}".format(payload[2:34].hex()))
+    if kind == "go_away" and payload[:1] == bytes([WRONG_CHAIN]):
+        raise P2PError("Peer is on another chain")
+    return {
+        "connect": connected - started,
+        "handshake": handshake - connected,
+        "message": kind,
+    }
@@ -0,0 +1,127 @@
+import threading
+import time
+import requests
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from include import latency, timings
+from include.dns import Resolver, resolving
+
+POOL_CONNECTIONS = 256
+POOL_MAXSIZE = 8
+
+
+class HttpPool:
+    """Keep-alive HTTP connections shared by every Checker
+
+    Wraps a single requests.Session whose adapter keeps one bounded
+    urllib3 pool per origin (scheme, host, port): at most pool_connections
+    origins are kept, each with at most pool_maxsize idle connections.
+    Counts requests and newly opened connections so each sweep can report
+    how many TCP/TLS handshakes keep-alive saved. New connections get
+    their address from the resolver's cache.
+    """
+
+    def __init__(
+        self,
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        keep_alive=True,
+        resolver=None,
+    ):
+        self.keep_alive = keep_alive
+        self.resolver = resolver or Resolver()
+        self.lock = threading.Lock()
+        self.requests = {"http": 0, "https": 0}
+        self.connections = {"http": 0, "https": 0}
+        self.bytes = 0
+
+        self.session = requests.Session()
+        # Producers must not see each other's cookies
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = CountingAdapter(
+            self, pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_config(cls, CONFIG, resolver=None):
+        settings = CONFIG.get("http", {})
+        return cls(
+            pool_connections=settings.get("pool_connections", POOL_CONNECTIONS),
+            pool_maxsize=settings.get("pool_maxsize", POOL_MAXSIZE),
+            keep_alive=settings.get("keep_alive", True),
+            resolver=resolver,
+        )
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        if not self.keep_alive:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), "Connection": "close"}
+        scheme = "https" if url.startswith("https") else "http"
+        with self.lock:
+            self.requests[scheme] += 1
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        finally:
+            timings.add("network_seconds", time.monotonic() - started)
+        latency.mark("ttfb", response.elapsed.total_seconds())
+        latency.mark("total", time.monotonic() - started)
+        if not kwargs.get("stream"):
+            # Already read; streamed bodies are counted by whoever reads them
+            with self.lock:
+                self.bytes += len(response.content)
+        return response
+
+    def pace(self, url):
+        """Called before non-HTTP connections; HttpPool doesn't pace them,
+        see RateLimitedHttp"""
+
+    def opened(self, scheme):
+        with self.lock:
+            self.connections[scheme] += 1
+
+    def stats(self):
+        with self.lock:
+            requests = sum(self.requests.values())
+            connections = sum(self.connections.values())
+            return {
+                "requests": requests,
+                "connections": connections,
+                "reused": requests - connections,
+                "tls_handshakes": self.connections["https"],
+                "tls_handshakes_saved": self.requests["https"]
+                - self.connections["https"],
+                "bytes": self.bytes,
+            }
+
+
+class CountingAdapter(HTTPAdapter):
+    def __init__(self, pool, **kwargs):
+        self.pool = pool
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": counting(HTTPConnectionPool, self.pool),
+            "https": counting(HTTPSConnectionPool, self.pool),
+        }
+
+
+def counting(pool_cls, pool):
+    class CountingConnectionPool(pool_cls):
+        ConnectionCls = resolving(pool_cls.ConnectionCls, pool.resolver)
+
+        def _new_conn(self):
+            pool.opened(self.scheme)
+            return super()._new_conn()
+
+    return CountingConnectionPool
@@ -0,0 +1,218 @@
+import threading
+import time
+from urllib.parse import urljoin
+from include.pool import HttpPool
+from include import timings
+
+PAGE_SIZE = 1000
+PRODUCERJSON_PAGE_SIZE = 500
+PRODUCERJSON_TTL = 300
+MIN_PAGE_SIZE = 50
+TTL = 60
+ATTEMPTS = 3
+WAIT = 2
+TIMEOUT = 30
+
+FIO_CHAIN_IDS = [
+    "21dcae42c0182200e93f954a074011f9048a7624c6fe81d3c9541a614a88bd1c",
+    "b20901380af44ef59c5918439a1f9a41d83669020319a80574b804a5f95cbd7e",
+]
+WAX_CHAIN_ID = "1064487b3cd1a897ce03ae5b6a865651747e2e152090f99c1d19d44e01aea5a4"
+
+
+class ProducerFetcher:
+    """Active producers of a chain, ranked by votes
+
+    Pages through /v1/chain/get_producers page_size rows at a time over the
+    shared HttpPool. A failed page is retried from the lower_bound it
+    started at, with the page size halved in case the node limits it, so
+    the pages already read are kept. Lists are cached per chain for ttl
+    seconds and callers asking for the same chain at once share one fetch.
+    """
+
+    def __init__(
+        self,
+        logging,
+        http=None,
+        page_size=PAGE_SIZE,
+        ttl=TTL,
+        attempts=ATTEMPTS,
+        wait=WAIT,
+    ):
+        self.logging = logging
+        self.http = http or HttpPool()
+        self.page_size = page_size
+        self.ttl = ttl
+        self.attempts = attempts
+        self.wait = wait
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.cached = {}
+
+    @classmethod
+    def from_config(cls, CONFIG, logging, http):
+        settings = CONFIG.get("producers", {})
+        return cls(
+            logging,
+            http=http,
+            page_size=settings.get("page_size", PAGE_SIZE),
+            ttl=settings.get("ttl", TTL),
+        )
+
+    def get(self, chain):
+        key = (chain["chain_id"], chain["api_node"], chain.get("limit"))
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            fetched, producers = self.cached.get(key, (0, None))
+            if producers is None or time.monotonic() - fetched > self.ttl:
+                producers = active_producers(chain, self.fetch(chain))
+                self.cached[key] = (time.monotonic(), producers)
+        # Callers update bp_json_url and the like in place
+        return [dict(producer) for producer in producers]
+
+    def fetch(self, chain):
+        url = urljoin(chain["api_node"], "/v1/chain/get_producers")
+        rows = []
+        lower_bound = ""
+        page_size = self.page_size
+        failures = 0
+        while True:
+            try:
+                response = self.http.post(
+                    url,
+                    json={"json": True, "lower_bound": lower_bound, "limit": page_size},
+                    timeout=TIMEOUT,
+                )
+                response.raise_for_status()
+                result = response.json()
+            except Exception as e:
+                self.logging.critical("Error getting producers: {}".format(e))
+                failures += 1
+                if failures >= self.attempts:
+                    raise
+                if page_size > MIN_PAGE_SIZE:
+                    page_size = max(page_size // 2, MIN_PAGE_SIZE)
+                timings.add("retries", 1)
+                timings.add("sleep_seconds", self.wait)
+                time.sleep(self.wait)
+                continue
+
+            failures = 0
+            # FIO nodes return the rows under "producers"
+            rows += result["producers"] if "producers" in result else result["rows"]
+            if not result["more"]:
+                return rows
+            lower_bound = result["more"]
+
+
+def active_producers(chain, rows):
+    active = []
+    for producer in rows:
+        if producer["is_active"] != 0:
+            if not producer["url"].startswith("http"):
+                producer["url"] = "http://" + producer["url"]
+            p = {
+                "owner": producer["owner"],
+                "url": producer["url"],
+                "bp_json_url": urljoin(producer["url"], "bp.json"),
+                "chains_json_url": urljoin(producer["url"], "/chains.json"),
+            }
+            if chain["chain_id"] in FIO_CHAIN_IDS:
+                p["fio_address"] = producer["fio_address"]
+
+            active.append(p)
+
+    if chain["chain_id"] == WAX_CHAIN_ID:
+        active = [
+            x
+            for x in active
+            if not (x["url"] == "https://wax.io" and x["owner"].endswith(".wax"))
+        ]
+
+    # false, null, 0 and negative numbers all mean every producer
+    limit = chain.get("limit")
+    if isinstance(limit, int) and not isinstance(limit, bool) and limit > 0:
+        active = active[:limit]
+
+    for num, _ in enumerate(active):
+        active[num]["position"] = num + 1
+        if num < 21:
+            active[num]["top21"] = True
+        else:
+            active[num]["top21"] = False
+
+    return active
+
+
+class ProducerJsonIndex:
+    """owner -> on-chain bp.json, read from the producerjson table in a few
+    large get_table_rows pages instead of one request per producer
+
+    The index is kept for ttl seconds; expire() makes the next get() scan
+    the table again. get() returns None if the scan failed.
+    """
+
+    def __init__(
+        self,
+        api_node,
+        logging,
+        http=None,
+        page_size=PRODUCERJSON_PAGE_SIZE,
+        ttl=PRODUCERJSON_TTL,
+    ):
+        self.api_node = api_node
+        self.logging = logging
+        self.http = http or HttpPool()
+        self.page_size = page_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.index = None
+        self.fetched = 0
+
+    def expire(self):
+        self.fetched = 0
+
+    def get(self, timeout):
+        with self.lock:
+            if time.monotonic() - self.fetched > self.ttl:
+                self.fetched = time.monotonic()
+                try:
+                    self.index = self.fetch(timeout)
+                except Exception as e:
+                    self.logging.critical(
+                        "Error getting producerjson table: {}".format(e)
+                    )
+                    self.index = None
+            return self.index
+
+    def fetch(self, timeout):
+        url = urljoin(self.api_node, "/v1/chain/get_table_rows")
+        index = {}
+        lower_bound = ""
+        while True:
+            response = self.http.post(
+                url,
+                json={
+                    "json": True,
+                    "code": "producerjson",
+                    "scope": "producerjson",
+                    "table": "producerjson",
+                    "lower_bound": lower_bound,
+                    "index_position": 1,
+                    "key_type": "",
+                    "limit": self.page_size,
+                    "reverse": False,
+                    "show_payer": True,
+                },
+                timeout=timeout,
+            )
+            response.raise_for_status()
+            result = response.json()
+            for row in result["rows"]:
+                index[row["data"]["owner"]] = row["data"]["json"]
+            if not result["more"]:
+                return index
+            if not result.get("next_key"):
+                raise ValueError("API node did not return next_key")
+            lower_bound = result["next_key"]
@@ -0,0 +1,76 @@
+import collections
+import os
+import re
+import sys
+import threading
+
+INTERVAL = 0.005
+# Innermost frames of threads waiting for work, left out of the samples
+IDLE = {("_worker", "thread.py")}
+
+
+class Sampler:
+    """Statistical profiler of every thread of the process
+
+    Every interval seconds the stack of each thread is recorded, rooted at
+    the thread's name with its number dropped so a pool's threads add up.
+    Pool threads waiting for work are left out.
+    write() saves the samples as collapsed stacks, one "root;caller;callee
+    count" line per distinct stack, which flamegraph.pl and speedscope
+    load. Unlike cProfile it sees the thread pool running the checks, and
+    it costs the threads it samples next to nothing.
+    """
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                code = frame.f_code
+                if ident == own or (
+                    (code.co_name, os.path.basename(code.co_filename)) in IDLE
+                ):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        "{} ({}:{})".format(
+                            code.co_name,
+                            os.path.basename(code.co_filename),
+                            code.co_firstlineno,
+                        )
+                    )
+                    frame = frame.f_back
+                root = re.sub(r"[_-]?\d+$", "", names.get(ident, "thread"))
+                stack.append(root)
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as fp:
+            for stack, count in self.stacks.most_common():
+                fp.write("{} {}\n".format(stack, count))
+
+    def top(self, limit=15):
+        """The functions most often on top of a stack, with their share of
+        the stacks sampled, busiest first"""
+        leaves = collections.Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        return [(leaf, count / total) for leaf, count in leaves.most_common(limit)]
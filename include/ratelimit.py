@@ -0,0 +1,133 @@
+import email.utils
+import threading
+import time
+from urllib.parse import urlparse
+from include import timings
+
+RATE = 5
+BURST = 10
+BACKOFF = 1
+MAX_BACKOFF = 60
+THROTTLED = (429, 503)
+
+
+def host_of(url):
+    """Host a request goes to; p2p endpoints are plain host:port"""
+    if "://" in url:
+        return urlparse(url).hostname or url
+    return url.rsplit(":", 1)[0]
+
+
+def retry_after(value):
+    """Seconds from a Retry-After header, None if there is none or it is
+    not a delay or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(
+            email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """Token bucket per host
+
+    Each host gets burst requests at once and rate requests per second
+    after that, so a host is only slowed down when it is hit repeatedly and
+    different hosts never wait on each other. A 429 or 503 answer holds the
+    host back for its Retry-After, or for a backoff that doubles with every
+    throttled answer in a row, up to max_backoff seconds.
+    """
+
+    def __init__(
+        self, rate=RATE, burst=BURST, backoff=BACKOFF, max_backoff=MAX_BACKOFF
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    @classmethod
+    def from_config(cls, chain_info, CONFIG):
+        settings = chain_info.get("rate_limit", CONFIG.get("rate_limit", {}))
+        return cls(
+            rate=settings.get("rate", RATE),
+            burst=settings.get("burst", BURST),
+            backoff=settings.get("backoff", BACKOFF),
+            max_backoff=settings.get("max_backoff", MAX_BACKOFF),
+        )
+
+    def acquire(self, host):
+        """Take a token for host, sleeping until one is available"""
+        wait = self.reserve(host)
+        if wait:
+            timings.add("sleep_seconds", wait)
+            time.sleep(wait)
+
+    def reserve(self, host):
+        """Take a token for host; returns how long to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            state = self.hosts.setdefault(
+                host,
+                {"tokens": self.burst, "updated": now, "until": 0, "backoff": 0},
+            )
+            state["tokens"] = min(
+                state["tokens"] + (now - state["updated"]) * self.rate, self.burst
+            )
+            state["updated"] = now
+            # Tokens may go negative: later callers queue behind earlier ones
+            state["tokens"] -= 1
+            return max(-state["tokens"] / self.rate, state["until"] - now, 0)
+
+    def observe(self, host, status_code, headers):
+        """Back off from host if it asked us to slow down"""
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                return
+            if status_code not in THROTTLED:
+                state["backoff"] = 0
+                return
+            delay = retry_after(headers.get("Retry-After"))
+            if delay is None:
+                delay = state["backoff"] * 2 or self.backoff
+                state["backoff"] = delay
+            delay = min(delay, self.max_backoff)
+            state["until"] = max(state["until"], time.monotonic() + delay)
+
+
+class RateLimitedHttp:
+    """HttpPool front that paces every request through a RateLimiter"""
+
+    def __init__(self, http, limiter):
+        self.http = http
+        self.limiter = limiter
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        host = host_of(url)
+        self.limiter.acquire(host)
+        response = self.http.request(method, url, **kwargs)
+        self.limiter.observe(host, response.status_code, response.headers)
+        return response
+
+    def pace(self, url):
+        """Wait for a token before opening a non-HTTP connection to url"""
+        self.limiter.acquire(host_of(url))
+
+    def stats(self):
+        return self.http.stats()
@@ -0,0 +1,191 @@
+import random
+import socket
+import ssl
+import threading
+import time
+import requests
+from include import timings
+
+ATTEMPTS = 3
+BACKOFF = 0.5
+MAX_BACKOFF = 4
+PRODUCER_BUDGET = 120
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class DeadlineExceeded(requests.exceptions.RequestException):
+    pass
+
+
+class Deadline:
+    """Point in time a producer or a sweep must be done by; a child deadline
+    never outlives its parent"""
+
+    def __init__(self, seconds, parent=None):
+        self.expires = time.monotonic() + seconds
+        if parent is not None:
+            self.expires = min(self.expires, parent.expires)
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+
+def causes(error):
+    """error and every exception it wraps"""
+    seen = []
+    pending = [error]
+    while pending:
+        e = pending.pop()
+        if not isinstance(e, BaseException) or any(e is s for s in seen):
+            continue
+        seen.append(e)
+        pending += [e.__cause__, e.__context__, getattr(e, "reason", None)]
+        pending += list(e.args)
+    return seen
+
+
+def classify(error):
+    """Why a request failed: "dns", "refused" and "tls" are not worth
+    retrying, "timeout" and "connection" are"""
+    if isinstance(error, requests.exceptions.Timeout):
+        return "timeout"
+    for e in causes(error):
+        if isinstance(e, socket.gaierror) or type(e).__name__ == "NameResolutionError":
+            return "dns"
+        if isinstance(e, ConnectionRefusedError):
+            return "refused"
+        if isinstance(e, (ssl.SSLError, requests.exceptions.SSLError)):
+            return "tls"
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return "connection"
+    return "other"
+
+
+class RetryPolicy:
+    """How often and how long to retry a request
+
+    Timeouts, dropped connections and 429/5xx answers are retried up to
+    attempts times in all, sleeping a random time of up to backoff * 2^n
+    (full jitter, capped at max_backoff) in between. DNS failures, refused
+    connections and TLS errors fail at once. A request never runs past
+    the deadline it is given: its timeout is cut to the time left and no
+    retry is started that couldn't finish in time. Counters record how
+    much of a run went into retries.
+
+    producer_budget is the time each producer gets within a sweep.
+    """
+
+    def __init__(
+        self,
+        attempts=ATTEMPTS,
+        backoff=BACKOFF,
+        max_backoff=MAX_BACKOFF,
+        producer_budget=PRODUCER_BUDGET,
+    ):
+        self.attempts = attempts
+        self.producer_budget = producer_budget
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "retries": 0,
+            "retry_seconds": 0.0,
+            "failed_fast": 0,
+            "deadline_exceeded": 0,
+        }
+
+    @classmethod
+    def from_config(cls, chain_info, CONFIG):
+        settings = chain_info.get("retry", CONFIG.get("retry", {}))
+        return cls(
+            attempts=settings.get("attempts", ATTEMPTS),
+            backoff=settings.get("backoff", BACKOFF),
+            max_backoff=settings.get("max_backoff", MAX_BACKOFF),
+            producer_budget=settings.get("producer_budget", PRODUCER_BUDGET),
+        )
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def run(self, send, timeout=None, deadline=None):
+        """Call send(timeout) until it returns a response worth keeping"""
+        self.count("requests")
+        attempt = 0
+        started = time.monotonic()
+        while True:
+            if deadline is not None:
+                remaining = deadline.remaining()
+                if remaining <= 0:
+                    self.count("deadline_exceeded")
+                    raise DeadlineExceeded("Time budget exhausted")
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            try:
+                response = send(timeout)
+                error = None
+            except requests.exceptions.RequestException as e:
+                if classify(e) in ("dns", "refused", "tls"):
+                    self.count("failed_fast")
+                    raise
+                response, error = None, e
+
+            attempt += 1
+            if attempt == 1:
+                first = time.monotonic() - started
+            if error is None and response.status_code not in RETRY_STATUS:
+                break
+            delay = random.uniform(
+                0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            )
+            if attempt >= self.attempts or (
+                deadline is not None and deadline.remaining() <= delay
+            ):
+                break
+            self.count("retries")
+            timings.add("retries", 1)
+            timings.add("sleep_seconds", delay)
+            time.sleep(delay)
+
+        if attempt > 1:
+            # Everything after the first attempt went into retrying
+            self.count("retry_seconds", time.monotonic() - started - first)
+        if error is not None:
+            raise error
+        return response
+
+
+class RetryingHttp:
+    """HTTP front that sends every request through a RetryPolicy, within
+    the deadline it is bound to"""
+
+    def __init__(self, http, policy, deadline=None):
+        self.http = http
+        self.policy = policy
+        self.deadline = deadline
+
+    def bound(self, deadline):
+        return RetryingHttp(self.http, self.policy, deadline)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, timeout=None, **kwargs):
+        return self.policy.run(
+            lambda timeout: self.http.request(method, url, timeout=timeout, **kwargs),
+            timeout=timeout,
+            deadline=self.deadline,
+        )
+
+    def pace(self, url):
+        self.http.pace(url)
+
+    def stats(self):
+        return self.http.stats()
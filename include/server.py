@@ -0,0 +1,314 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import re
+import urllib.parse
+from include.changes import summarize
+from include.output import dumps
+
+HOST = "127.0.0.1"
+PORT = 8080
+GZIP_LEVEL = 6
+MIN_GZIP_BYTES = 1024
+IDLE_TIMEOUT = 30
+MAX_CHANGES = 1000
+MAX_RESPONSES = 1024
+TOP = 21
+JSON = "application/json"
+METRICS = "text/plain; version=0.0.4"
+FEATURES = ["api", "p2p", "history", "hyperion", "atomic", "ipfs", "lightapi"]
+REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+
+class Response:
+    """A serialized answer with its strong ETag, and the gzipped body
+    made the first time a client accepts it"""
+
+    def __init__(self, status, body, gzip_level=GZIP_LEVEL, content_type=JSON):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        self.gzip_level = gzip_level
+        self.gzipped = None
+
+    def encoded(self, accept_gzip):
+        """Body and ETag to send, gzipped when the client takes it and it
+        is worth it"""
+        if not accept_gzip or len(self.body) < MIN_GZIP_BYTES:
+            return self.body, self.etag, None
+        if self.gzipped is None:
+            self.gzipped = gzip.compress(self.body, self.gzip_level, mtime=0)
+        return self.gzipped, self.etag[:-1] + '-gzip"', "gzip"
+
+
+class Snapshot:
+    """What was last published of a chain, and the responses made from it"""
+
+    def __init__(self, chain_info, data, summary, changes):
+        self.chain_info = chain_info
+        self.data = data
+        self.summary = summary
+        self.changes = changes
+        self.producers = {p["account"]: p for p in data["producers"]}
+        self.responses = {}
+
+
+class StatusServer:
+    """HTTP/1.1 API over the latest results of each chain, from memory
+
+        GET /v1/chains
+        GET /v1/chains/<chain_id>                      the published data
+        GET /v1/chains/<chain_id>/summary              status, counts and errors
+        GET /v1/chains/<chain_id>/healthy/<feature>    ?top21=1 for the top 21
+        GET /v1/chains/<chain_id>/top21
+        GET /v1/chains/<chain_id>/producers/<account>
+        GET /v1/chains/<chain_id>/changes?since=<seq>
+        GET /metrics                                   see Metrics
+
+    Responses are made once per published sweep and carry a strong ETag,
+    so clients polling with If-None-Match mostly get a 304, and are
+    gzipped for clients that accept it. update() is called from any
+    thread and swaps the chain's snapshot at once.
+    """
+
+    def __init__(
+        self, logging, host=HOST, port=PORT, gzip_level=GZIP_LEVEL, metrics=None
+    ):
+        self.logging = logging
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.gzip_level = gzip_level
+        self.chains = {}
+        self.server = None
+        self.routes = [
+            (re.compile(r"/v1/chains/?"), self.chain_list),
+            (re.compile(r"/v1/chains/([0-9a-f]+)/?"), self.chain),
+            (re.compile(r"/v1/chains/([0-9a-f]+)/summary"), self.chain_summary),
+            (re.compile(r"/v1/chains/([0-9a-f]+)/healthy/(\w+)"), self.healthy),
+            (re.compile(r"/v1/chains/([0-9a-f]+)/top21"), self.top21),
+            (re.compile(r"/v1/chains/([0-9a-f]+)/producers/([\w.]+)"), self.producer),
+            (re.compile(r"/v1/chains/([0-9a-f]+)/changes"), self.changes),
+        ]
+
+    @classmethod
+    def from_config(cls, CONFIG, logging, metrics=None):
+        settings = CONFIG.get("server", {})
+        return cls(
+            logging,
+            host=settings.get("host", HOST),
+            port=settings.get("port", PORT),
+            gzip_level=settings.get("gzip_level", GZIP_LEVEL),
+            metrics=metrics,
+        )
+
+    def update(self, chain_info, data, summary=None, changes=()):
+        """Serve data as chain_info's results from now on"""
+        self.chains[chain_info["chain_id"]] = Snapshot(
+            chain_info,
+            data,
+            summary if summary is not None else summarize(data),
+            list(changes)[-MAX_CHANGES:],
+        )
+
+    def load(self, chain_info, path, summary=None, changes=()):
+        """Serve what a previous run published at path until the first
+        sweep is done"""
+        try:
+            with open(path, "r") as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return
+        self.update(chain_info, data, summary, changes)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.logging.info(
+            "Serving on http://{}:{}/v1/chains".format(self.host, self.port)
+        )
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await asyncio.wait_for(
+                    self.read_request(reader), IDLE_TIMEOUT
+                )
+                if request is None:
+                    break
+                method, target, version, headers = request
+                keep_alive = version == "HTTP/1.1" and (
+                    headers.get("connection", "").lower() != "close"
+                )
+                writer.write(self.respond(method, target, headers, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ValueError, asyncio.LimitOverrunError):
+            writer.write(self.head(400, b"", None, None, False))
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        """(method, target, version, headers) of the next request, None at
+        the end of the connection"""
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method, target, version = line.decode("latin-1").split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return method, target, version, headers
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    def respond(self, method, target, headers, keep_alive):
+        if method not in ("GET", "HEAD"):
+            return self.head(405, b"", None, None, keep_alive)
+        url = urllib.parse.urlsplit(target)
+        if url.path == "/metrics" and self.metrics:
+            response = Response(200, self.metrics.render(), self.gzip_level, METRICS)
+        else:
+            response = self.lookup(url.path, url.query)
+        accept_gzip = "gzip" in headers.get("accept-encoding", "")
+        body, etag, encoding = response.encoded(accept_gzip)
+        tags = {tag.strip() for tag in headers.get("if-none-match", "").split(",")}
+        if response.status == 200 and tags & {etag, response.etag, "*"}:
+            return self.head(304, b"", etag, None, keep_alive, length=False)
+        head = self.head(
+            response.status,
+            body,
+            etag,
+            encoding,
+            keep_alive,
+            content_type=response.content_type,
+        )
+        return head if method == "HEAD" else head + body
+
+    def head(
+        self, status, body, etag, encoding, keep_alive, length=True, content_type=JSON
+    ):
+        lines = [
+            "HTTP/1.1 {} {}".format(status, REASONS[status]),
+            "Content-Type: {}".format(content_type),
+            "Cache-Control: no-cache",
+            "Vary: Accept-Encoding",
+            "Access-Control-Allow-Origin: *",
+            "Connection: {}".format("keep-alive" if keep_alive else "close"),
+        ]
+        if length:
+            lines.append("Content-Length: {}".format(len(body)))
+        if etag:
+            lines.append("ETag: {}".format(etag))
+        if encoding:
+            lines.append("Content-Encoding: {}".format(encoding))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    def lookup(self, path, query):
+        """Response for path and query string, made once per snapshot of the
+        chain"""
+        for pattern, route in self.routes:
+            match = pattern.fullmatch(path)
+            if not match:
+                continue
+            args = match.groups()
+            if not args:
+                return self.response(200, route())
+            snapshot = self.chains.get(args[0])
+            if snapshot is None:
+                return self.error(404, "Unknown chain {}".format(args[0]))
+            response = snapshot.responses.get((path, query))
+            if response is None:
+                data = route(snapshot, *args[1:], urllib.parse.parse_qs(query))
+                if data is None:
+                    return self.error(404, "Nothing at {}".format(path))
+                response = self.response(200, data)
+                if len(snapshot.responses) < MAX_RESPONSES:
+                    snapshot.responses[path, query] = response
+            return response
+        return self.error(404, "Nothing at {}".format(path))
+
+    def response(self, status, data):
+        return Response(status, dumps(data), self.gzip_level)
+
+    def error(self, status, message):
+        return self.response(status, {"error": message})
+
+    def chain_list(self):
+        return [
+            {
+                "chain_id": chain_id,
+                "name": snapshot.chain_info.get("name"),
+                "testnet": snapshot.chain_info.get("testnet", False),
+                "last_update_iso": snapshot.data.get("last_update_iso"),
+                "seq": snapshot.summary.get("seq"),
+            }
+            for chain_id, snapshot in sorted(self.chains.items())
+        ]
+
+    def chain(self, snapshot, query):
+        return snapshot.data
+
+    def chain_summary(self, snapshot, query):
+        return snapshot.summary
+
+    def healthy(self, snapshot, feature, query):
+        if feature not in FEATURES:
+            return None
+        endpoints = snapshot.data.get("healthy_{}_endpoints".format(feature), [])
+        if feature == "api" and "fastest_api_endpoints" in snapshot.data:
+            endpoints = snapshot.data["fastest_api_endpoints"]
+        if query.get("top21", ["0"])[-1] not in ("0", "false", ""):
+            urls = {
+                url
+                for producer in top(snapshot.data["producers"])
+                for url in producer["endpoints"]
+            }
+            endpoints = [url for url in endpoints if url in urls]
+        return endpoints
+
+    def top21(self, snapshot, query):
+        return sorted(
+            top(snapshot.summary["producers"]),
+            key=lambda producer: producer["position"],
+        )
+
+    def producer(self, snapshot, account, query):
+        return snapshot.producers.get(account)
+
+    def changes(self, snapshot, query):
+        """Feed lines after seq since, all that are kept without it"""
+        try:
+            since = int(query.get("since", ["0"])[-1])
+        except ValueError:
+            return None
+        return [
+            change
+            for change in map(json.loads, snapshot.changes)
+            if change["seq"] > since
+        ]
+
+
+def top(producers):
+    """The producers in the top TOP positions"""
+    return [
+        producer
+        for producer in producers
+        if isinstance(producer.get("position"), int) and producer["position"] <= TOP
+    ]
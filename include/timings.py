@@ -0,0 +1,123 @@
+import contextlib
+import datetime
+import threading
+import time
+
+# What instrumented code reports while a phase is running on its thread
+COUNTERS = ["network_seconds", "sleep_seconds", "retries"]
+
+local = threading.local()
+
+
+def add(counter, value):
+    """Add value to counter of every phase running on this thread"""
+    for frame in getattr(local, "stack", ()):
+        frame[counter] += value
+
+
+class Timings:
+    """Where the time of a chain's sweeps goes
+
+    Phases are the sequential steps of a sweep or a publish, methods the
+    Checker and Engine calls run for each producer, many at once, so
+    their wall times add up to more than the sweep's. Each gets a count
+    and its wall, CPU, network and sleeping seconds plus its retries.
+    Network, sleeping and retries are reported by HttpPool, RateLimiter
+    and RetryPolicy through add() on the thread they run on; for phases
+    spent awaiting, they are the sum of the methods'. CPU is the thread's
+    for methods and the process's for phases, which chains checked at
+    once share.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.phases = {}
+        self.methods = {}
+        self.awaiting = set()
+
+    @contextlib.contextmanager
+    def phase(self, name, awaiting=False):
+        """Time the block as phase name; awaiting for a block that awaits,
+        whose counters are then those of the methods"""
+        if awaiting:
+            self.awaiting.add(name)
+        with self.measure(self.phases, name, time.process_time, not awaiting):
+            yield
+
+    @contextlib.contextmanager
+    def method(self, name):
+        with self.measure(self.methods, name, time.thread_time):
+            yield
+
+    def timed(self, name, fn, phase=False):
+        """fn, timed as method name, or phase name, wherever it runs"""
+        timer = self.phase if phase else self.method
+
+        def run(*args):
+            with timer(name):
+                return fn(*args)
+
+        return run
+
+    @contextlib.contextmanager
+    def measure(self, table, name, cpu_clock, counted=True):
+        frame = dict.fromkeys(COUNTERS, 0) if counted else {}
+        stack = getattr(local, "stack", None)
+        if stack is None:
+            stack = local.stack = []
+        if counted:
+            stack.append(frame)
+        wall, cpu = time.monotonic(), cpu_clock()
+        try:
+            yield
+        finally:
+            if counted:
+                stack.pop()
+            frame["wall_seconds"] = time.monotonic() - wall
+            frame["cpu_seconds"] = cpu_clock() - cpu
+            self.record(table, name, frame)
+
+    def record_method(self, name, **values):
+        """Record a method run on the event loop, timed by its caller"""
+        self.record(self.methods, name, values)
+
+    def record(self, table, name, values):
+        with self.lock:
+            entry = table.setdefault(name, {"count": 0})
+            entry["count"] += 1
+            for key, value in values.items():
+                entry[key] = entry.get(key, 0) + value
+                if key == "wall_seconds":
+                    entry["max_wall_seconds"] = max(
+                        entry.get("max_wall_seconds", 0), value
+                    )
+
+    def drain(self):
+        """Report of everything timed since the last drain"""
+        with self.lock:
+            methods = self.methods
+            awaiting = self.awaiting
+            report = {
+                "started": datetime.datetime.utcfromtimestamp(self.started).isoformat(),
+                "wall_seconds": time.time() - self.started,
+                "phases": self.phases,
+                "methods": methods,
+            }
+            self.reset()
+        for name, phase in report["phases"].items():
+            if name in awaiting:
+                for counter in COUNTERS:
+                    phase[counter] = sum(m.get(counter, 0) for m in methods.values())
+        return rounded(report)
+
+
+def rounded(value):
+    if isinstance(value, dict):
+        return {key: rounded(item) for key, item in value.items()}
+    if isinstance(value, float):
+        return round(value, 4)
+    return value
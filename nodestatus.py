@@ -2,6 +2,7 @@
 
 import logging
 import argparse
+import asyncio
 import os
 import colorlog
 import inspect
@@ -11,11 +12,26 @@ import random
 import traceback
 import json
 import datetime
-import eospy.cleos
-from tenacity import retry, stop_after_attempt, wait_fixed
-from urllib.parse import urljoin, urlparse
-from include.checker import Checker
-import glob
+import functools
+from include.engine import Engine, CONCURRENCY, PER_HOST_CONCURRENCY, P2P_CONCURRENCY
+from include.pool import HttpPool
+from include.daemon import ChainMonitor
+from include.cache import HttpCache
+from include.bundle import Bundle, NUM_DAYS
+from include.output import Publisher, write_file
+from include.changes import ChangeFeed
+from include.server import StatusServer
+from include.metrics import Metrics, stats_collector
+from include.history import HistoryStore
+from include.producers import ProducerFetcher, FIO_CHAIN_IDS
+from include.canonical import HashCache
+from include.ratelimit import RateLimiter
+from include.retry import RetryPolicy
+from include.breaker import CircuitBreaker
+from include.dns import Resolver
+from include.document import DocumentFetcher
+from include.latency import summary, fastest
+from include.profiler import Sampler
 
 pp = pprint.PrettyPrinter(indent=4)
 
@@ -32,6 +48,26 @@ parser.add_argument(
 parser.add_argument(
     "-d", "--debug", action="store_true", dest="debug", help="Print debug info"
 )
+parser.add_argument(
+    "--daemon",
+    action="store_true",
+    dest="daemon",
+    help="Keep running and re-check endpoints on their own intervals",
+)
+parser.add_argument(
+    "--serve",
+    action="store_true",
+    dest="serve",
+    help="Serve the latest results over HTTP, implies --daemon",
+)
+parser.add_argument(
+    "--profile",
+    nargs="?",
+    const="{}.folded".format(os.path.basename(__file__).split(".")[0]),
+    dest="profile",
+    help="Sample every thread's stack and write them to this file, "
+    "as collapsed stacks for flamegraph.pl or speedscope",
+)
 parser.add_argument(
     "-l",
     "--log_file",
@@ -43,7 +79,10 @@ args = parser.parse_args()
 
 VERBOSE = args.verbose
 DEBUG = args.debug
+SERVE = args.serve
+DAEMON = args.daemon or SERVE
 LOG_FILE = args.log_file
+PROFILE = args.profile
 CHAINS = []
 
 if DEBUG:
@@ -69,94 +108,286 @@ fh.setFormatter(formatter)
 SCRIPT_PATH = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-def get_producers(chain):
-    try:
-        LIMIT = 200
-        CLEOS = eospy.cleos.Cleos(url=chain["api_node"])
-        result = CLEOS.get_producers(limit=LIMIT)
-
-        isFIO = (
-            chain["chain_id"]
-            == "21dcae42c0182200e93f954a074011f9048a7624c6fe81d3c9541a614a88bd1c"
-            or chain["chain_id"]
-            == "b20901380af44ef59c5918439a1f9a41d83669020319a80574b804a5f95cbd7e"
-        )
-
+def get_chains(CONFIG):
+    """Mainnets in config.json followed by the testnets listed under each,
+    testnets inheriting the settings of their mainnet"""
+    chains = []
+    for chain in CONFIG["chains"]:
+        mainnet = {k: v for k, v in chain.items() if k != "testnets"}
+        chains.append(mainnet)
+        for testnet in chain.get("testnets", []):
+            chains.append({**mainnet, "testnet": True, **testnet})
+    return chains
+
+
+def build_chain_data(chain_info, producers, checkers):
+    healthy_api_endpoints = []
+    healthy_p2p_endpoints = []
+    healthy_history_endpoints = []
+    healthy_hyperion_endpoints = []
+    healthy_atomic_endpoints = []
+    healthy_ipfs_endpoints = []
+    healthy_lightapi_endpoints = []
+    producers_array = []
+
+    isFIO = chain_info["chain_id"] in FIO_CHAIN_IDS
+
+    for producer, checker in zip(producers, checkers):
+        healthy_api_endpoints += checker.healthy_api_endpoints
+        healthy_p2p_endpoints += checker.healthy_p2p_endpoints
+        healthy_history_endpoints += checker.healthy_history_endpoints
+        healthy_hyperion_endpoints += checker.healthy_hyperion_endpoints
+        healthy_atomic_endpoints += checker.healthy_atomic_endpoints
+        healthy_ipfs_endpoints += checker.healthy_ipfs_endpoints
+        healthy_lightapi_endpoints += checker.healthy_lightapi_endpoints
+
+        producer_info = {
+            "account": producer["owner"],
+            "org_name": checker.org_name,
+            "bp_json_content": checker.bp_json,
+            "history": len(checker.healthy_history_endpoints),
+            "hyperion": len(checker.healthy_hyperion_endpoints),
+            "atomic": len(checker.healthy_atomic_endpoints),
+            "lightapi": len(checker.healthy_lightapi_endpoints),
+            "position": checker.producer_info["position"],
+            "status": checker.status,
+            "errors": checker.errors,
+            "oks": checker.oks,
+            "warnings": checker.warnings,
+            "endpoint_errors": checker.endpoint_errors,
+            "endpoint_oks": checker.endpoint_oks,
+            "endpoints": checker.endpoints,
+            # 'p2p_endpoints': checker.p2p_endpoints,
+            "bp_json": checker.producer_info["bp_json_url"],
+            "onchain_bp_json": checker.onchain_bp_json,
+        }
         if isFIO:
-            producers = result["producers"]
+            producer_info["fio_address"] = producer["fio_address"]
+
+        producers_array.append(producer_info)
+
+    healthy_api_endpoints = list(set(healthy_api_endpoints))
+    healthy_p2p_endpoints = list(set(healthy_p2p_endpoints))
+    healthy_history_endpoints = list(set(healthy_history_endpoints))
+    healthy_atomic_endpoints = list(set(healthy_atomic_endpoints))
+    healthy_hyperion_endpoints = list(set(healthy_hyperion_endpoints))
+    healthy_ipfs_endpoints = list(set(healthy_ipfs_endpoints))
+    healthy_lightapi_endpoints = list(set(healthy_lightapi_endpoints))
+    random.shuffle(producers_array)
+    random.shuffle(healthy_api_endpoints)
+    random.shuffle(healthy_p2p_endpoints)
+    random.shuffle(healthy_history_endpoints)
+    random.shuffle(healthy_atomic_endpoints)
+    random.shuffle(healthy_hyperion_endpoints)
+    random.shuffle(healthy_ipfs_endpoints)
+    random.shuffle(healthy_lightapi_endpoints)
+
+    data = {
+        "producers": producers_array,
+        "last_update": datetime.datetime.utcnow().strftime("%d/%m/%y %H:%M:%S UTC"),
+        "last_update_iso": datetime.datetime.utcnow().isoformat(),
+        "healthy_api_endpoints": healthy_api_endpoints,
+        "healthy_p2p_endpoints": healthy_p2p_endpoints,
+        "healthy_history_endpoints": healthy_history_endpoints,
+        "healthy_hyperion_endpoints": healthy_hyperion_endpoints,
+        "healthy_atomic_endpoints": healthy_atomic_endpoints,
+        "healthy_ipfs_endpoints": healthy_ipfs_endpoints,
+        "healthy_lightapi_endpoints": healthy_lightapi_endpoints,
+    }
+
+    return data
+
+
+def add_latency(chain_info, data, history, date):
+    """Latency percentiles of the producers' endpoints per probe kind over
+    the retained days; the healthy API endpoints ranked by their api
+    probes go to data"""
+    start = datetime.date.fromisoformat(date) - datetime.timedelta(days=NUM_DAYS - 1)
+    endpoints = history.latency(chain_info["chain_id"], start.isoformat())
+    urls = {url for producer in data["producers"] for url in producer["endpoints"]}
+    latency = {
+        url: {kind: summary(histograms) for kind, histograms in kinds.items()}
+        for url, kinds in endpoints.items()
+        if url in urls
+    }
+    data["fastest_api_endpoints"] = fastest(data["healthy_api_endpoints"], latency)
+    return {"last_update_iso": data.get("last_update_iso"), "latency": latency}
+
+
+def write_chain(chain_info, data, latency, timings, shared, archive=True):
+    """Publish data; with archive, also record latency and the day in the
+    history store and update the bundle and latency files, which the
+    daemon does less often than it publishes"""
+    PUB_PATH = "{}/pub".format(SCRIPT_PATH)
+    CURRENT_DATE = datetime.datetime.today().strftime("%Y-%m-%d")
+    history = shared["history"]
+    publisher = shared["publisher"]
+    chain_id = chain_info["chain_id"]
+    with timings.phase("latency"):
+        if archive:
+            history.record_latency(chain_id, CURRENT_DATE, latency)
+            shared["latency"][chain_id] = add_latency(
+                chain_info, data, history, CURRENT_DATE
+            )
         else:
-            producers = result["rows"]
-
-        while result["more"] != "":
-            result = CLEOS.get_producers(limit=LIMIT, lower_bound=result["more"])
-            if isFIO:
-                producers += result["producers"]
-            else:
-                producers += result["rows"]
-
-        active_producers = []
-        for producer in producers:
-            if producer["is_active"] != 0:
-                if not producer["url"].startswith("http"):
-                    producer["url"] = "http://" + producer["url"]
-                p = {
-                    "owner": producer["owner"],
-                    "url": producer["url"],
-                    "bp_json_url": urljoin(producer["url"], "bp.json"),
-                    "chains_json_url": urljoin(producer["url"], "/chains.json"),
-                }
-                if isFIO:
-                    p["fio_address"] = producer["fio_address"]
-
-                active_producers.append(p)
-
-        if (
-            chain["chain_id"]
-            == "1064487b3cd1a897ce03ae5b6a865651747e2e152090f99c1d19d44e01aea5a4"
-        ):
-            active_producers = [
-                x
-                for x in active_producers
-                if not (x["url"] == "https://wax.io" and x["owner"].endswith(".wax"))
-            ]
-
-        if chain["limit"]:
-            active_producers = active_producers[: chain["limit"]]
-
-        for num, _ in enumerate(active_producers):
-            active_producers[num]["position"] = num + 1
-            if num < 21:
-                active_producers[num]["top21"] = True
-            else:
-                active_producers[num]["top21"] = False
-
-        return active_producers
+            data["fastest_api_endpoints"] = fastest(
+                data["healthy_api_endpoints"],
+                shared["latency"].get(chain_id, {}).get("latency", {}),
+            )
+    if not os.path.exists(PUB_PATH):
+        os.makedirs(PUB_PATH)
+    feed = shared["feeds"][chain_id]
+    with timings.phase("changes"):
+        entry = feed.update(data)
+    copies = []
+    if archive and history.daily_snapshots:
+        copies.append("{}/{}-{}.json".format(PUB_PATH, chain_id, CURRENT_DATE))
+    with timings.phase("publish"):
+        publisher.publish(data, "{}/{}.json".format(PUB_PATH, chain_id), *copies)
+        if archive:
+            # Kept apart: it is as large as the rest and only the ranking changes
+            publisher.publish(
+                shared["latency"][chain_id],
+                "{}/{}-latency.json".format(PUB_PATH, chain_id),
+            )
+        feed.write()
+        if shared.get("server"):
+            shared["server"].update(chain_info, data, feed.summary, feed.lines)
+    if entry:
+        logging.info("Change {} published".format(entry["seq"]))
+    if not archive:
+        return
+    with timings.phase("history"):
+        history.record(chain_id, CURRENT_DATE, data)
+
+    logging.info("Generating bundle")
+    with timings.phase("bundle"):
+        Bundle(PUB_PATH, chain_id, history=history, publisher=publisher).update(
+            CURRENT_DATE, data
+        )
+
+
+def write_timings(chain_info, report, shared):
+    """Where the time since the last publish went, next to the chain's file"""
+    report = dict(chain=chain_info["name"], chain_id=chain_info["chain_id"], **report)
+    path = "{}/pub/{}-timings.json".format(SCRIPT_PATH, chain_info["chain_id"])
+    publisher = shared["publisher"]
+    write_file(path, publisher.dumps(report, publisher.indent), fsync=False)
+
+
+def chain_engine(chain_info, CONFIG, shared):
+    return Engine(
+        chain_info,
+        logging,
+        concurrency=chain_info.get("workers", CONFIG.get("concurrency", CONCURRENCY)),
+        per_host=CONFIG.get("per_host_concurrency", PER_HOST_CONCURRENCY),
+        p2p_concurrency=CONFIG.get("p2p_concurrency", P2P_CONCURRENCY),
+        http=shared["http"],
+        cache=shared["cache"],
+        hashes=shared["hashes"],
+        limiter=RateLimiter.from_config(chain_info, CONFIG),
+        policy=RetryPolicy.from_config(chain_info, CONFIG),
+        breaker=shared["breaker"],
+        resolver=shared["resolver"],
+        documents=shared["documents"],
+        metrics=shared["metrics"],
+    )
+
+
+async def publish_chain(
+    chain_info, producers, checkers, latency, timings, shared, archive=True
+):
+    with timings.phase("build"):
+        data = build_chain_data(chain_info, producers, checkers)
+    await asyncio.to_thread(
+        write_chain, chain_info, data, latency, timings, shared, archive
+    )
+    shared["metrics"].inc("nodestatus_publishes_total", chain_info["name"])
+    await asyncio.to_thread(
+        timings.timed("metrics", shared["metrics"].write, phase=True)
+    )
+    await asyncio.to_thread(write_timings, chain_info, timings.drain(), shared)
+
+
+async def check_chain(chain_info, CONFIG, shared):
+    """Check one chain within its time budget and publish it right away"""
+    logging.info("Inspecting chain {}".format(chain_info))
+    started = time.monotonic()
+    budget = chain_info.get("time_budget", CONFIG.get("time_budget"))
+
+    engine = chain_engine(chain_info, CONFIG, shared)
+    get_producers = engine.timings.timed(
+        "get_producers", shared["fetcher"].get, phase=True
+    )
+    try:
+        producers = await asyncio.to_thread(get_producers, chain_info)
 
     except Exception as e:
-        logging.critical("Error getting producers: {}".format(e))
-        raise
+        logging.critical("Too many retries getting producers")
+        return
 
+    if budget is not None:
+        budget = max(budget - (time.monotonic() - started), 0)
+    with engine.timings.phase("sweep", awaiting=True):
+        checkers = await engine.run_async(producers, budget)
 
-def bundle(CHAINS):
-    PUB_PATH = "{}/pub".format(SCRIPT_PATH)
-    NUM_DAYS = 45
+    await publish_chain(
+        chain_info, producers, checkers, engine.latency.drain(), engine.timings, shared
+    )
+    shared["metrics"].observe(
+        "nodestatus_sweep_duration_seconds",
+        chain_info["name"],
+        value=time.monotonic() - started,
+    )
+    logging.info(
+        "Chain {} done in {:.1f}s".format(
+            chain_info["name"], time.monotonic() - started
+        )
+    )
 
-    for CHAIN in CHAINS:
-        CHAIN_ID = CHAIN["chain_id"]
-        SEARCH_TERM = f"{PUB_PATH}/{CHAIN_ID}-2*"
-        BUNDLE_PATH = f"{PUB_PATH}/{CHAIN_ID}-bundle.json"
-        bundle = {}
-        files = sorted(list(filter(os.path.isfile, glob.glob(SEARCH_TERM + "*"))))[
-            -NUM_DAYS:
-        ]
-        for file in files:
-            date = file[-15:-5]
-            with open(file, "r") as fp:
-                bundle[date] = json.load(fp)
 
-        with open(BUNDLE_PATH, "w") as fp:
-            json.dump(bundle, fp, indent=2)
+async def check_chains(CHAINS, CONFIG, shared):
+    results = await asyncio.gather(
+        *[check_chain(chain_info, CONFIG, shared) for chain_info in CHAINS],
+        return_exceptions=True,
+    )
+    for chain_info, result in zip(CHAINS, results):
+        if isinstance(result, Exception):
+            logging.critical(
+                "Error checking chain {}: {}".format(chain_info["name"], result)
+            )
+
+
+async def monitor_chains(CHAINS, CONFIG, shared):
+    if shared.get("server"):
+        await shared["server"].start()
+    monitors = [
+        ChainMonitor(
+            chain_info,
+            chain_engine(chain_info, CONFIG, shared),
+            shared["fetcher"].get,
+            functools.partial(publish_chain, shared=shared),
+            CONFIG.get("daemon", {}),
+            logging,
+        )
+        for chain_info in CHAINS
+    ]
+    await asyncio.gather(*[monitor.run() for monitor in monitors])
+
+
+def register_metrics(shared):
+    """Expose the counters the shared objects keep as metrics"""
+    metrics = shared["metrics"]
+    for prefix, name, help, gauges in [
+        ("nodestatus_http", "http", "Requests through the HTTP pool", ()),
+        ("nodestatus_documents", "documents", "bp.json and chains.json read", ()),
+        ("nodestatus_dns", "resolver", "Host name lookups", ("hosts",)),
+        ("nodestatus_cache", "cache", "bp.json cache", ("entries", "bytes")),
+        ("nodestatus_breaker", "breaker", "Endpoint breakers", ("open", "failing")),
+    ]:
+        metrics.collect(
+            stats_collector(prefix, shared[name].stats, help, gauges=gauges)
+        )
 
 
 def main():
@@ -164,124 +395,87 @@ def main():
     try:
         with open(CONFIG_PATH, "r") as fp:
             CONFIG = json.load(fp)
-            CHAINS = CONFIG["chains"]
+            CHAINS = get_chains(CONFIG)
     except Exception as e:
         logging.critical("Error getting config from {}: {}".format(CONFIG_PATH, e))
         quit()
 
-    bundle(CHAINS)
-    logging.info("Generating bundle")
-
-    for chain_info in CHAINS:
-        logging.info("Inspecting chain {}".format(chain_info))
-        healthy_api_endpoints = []
-        healthy_p2p_endpoints = []
-        healthy_history_endpoints = []
-        healthy_hyperion_endpoints = []
-        healthy_atomic_endpoints = []
-        healthy_ipfs_endpoints = []
-        healthy_lightapi_endpoints = []
-        producers_array = []
-
-        isFIO = (
-            chain_info["chain_id"]
-            == "21dcae42c0182200e93f954a074011f9048a7624c6fe81d3c9541a614a88bd1c"
-            or chain_info["chain_id"]
-            == "b20901380af44ef59c5918439a1f9a41d83669020319a80574b804a5f95cbd7e"
+    # State every chain shares: connections, caches and stores
+    resolver = Resolver.from_config(CONFIG)
+    http = HttpPool.from_config(CONFIG, resolver)
+    documents = DocumentFetcher.from_config(CONFIG)
+    publisher = Publisher.from_config(CONFIG, logging)
+    PUB_PATH = "{}/pub".format(SCRIPT_PATH)
+    shared = {
+        "resolver": resolver,
+        "http": http,
+        "documents": documents,
+        "cache": HttpCache.from_config(CONFIG, http, SCRIPT_PATH, documents),
+        "hashes": HashCache.from_config(CONFIG, SCRIPT_PATH),
+        "breaker": CircuitBreaker.from_config(CONFIG, SCRIPT_PATH, http),
+        "history": HistoryStore.from_config(CONFIG, SCRIPT_PATH),
+        "publisher": publisher,
+        "feeds": {
+            chain_info["chain_id"]: ChangeFeed.from_config(
+                CONFIG, PUB_PATH, chain_info["chain_id"], publisher
+            )
+            for chain_info in CHAINS
+        },
+        "fetcher": ProducerFetcher.from_config(CONFIG, logging, http),
+        "metrics": Metrics.from_config(CONFIG, SCRIPT_PATH),
+        # chain_id -> the latency file last published, see add_latency
+        "latency": {},
+    }
+    register_metrics(shared)
+    if SERVE:
+        shared["server"] = StatusServer.from_config(CONFIG, logging, shared["metrics"])
+        for chain_info in CHAINS:
+            # What the last run published, until the first sweep is done
+            feed = shared["feeds"][chain_info["chain_id"]]
+            feed.load()
+            shared["server"].load(
+                chain_info,
+                "{}/{}.json".format(PUB_PATH, chain_info["chain_id"]),
+                feed.summary,
+                feed.lines,
+            )
+    if DAEMON:
+        asyncio.run(monitor_chains(CHAINS, CONFIG, shared))
+        return
+
+    asyncio.run(check_chains(CHAINS, CONFIG, shared))
+    shared["history"].close()
+    shared["metrics"].write()
+    logging.info(
+        "HTTP pool: {requests} requests over {connections} connections, "
+        "{reused} reused, {tls_handshakes_saved} TLS handshakes saved".format(
+            **http.stats()
         )
+    )
+    logging.info(
+        "bp.json cache: {hits} not modified, {misses} fetched, "
+        "{entries} entries, {bytes} bytes".format(**shared["cache"].stats())
+    )
 
-        try:
-            producers = get_producers(chain_info)
-
-        except Exception as e:
-            logging.critical("Too many retries getting producers")
-            continue
-
-        for producer in producers:
-#             if producer["owner"] != "ledgerwiseio":
-#                 continue
-            logging.info("Checking producer {}".format(producer["owner"]))
-            checker = Checker(chain_info, producer, logging)
-            checker.run_checks()
-
-            healthy_api_endpoints += checker.healthy_api_endpoints
-            healthy_p2p_endpoints += checker.healthy_p2p_endpoints
-            healthy_history_endpoints += checker.healthy_history_endpoints
-            healthy_hyperion_endpoints += checker.healthy_hyperion_endpoints
-            healthy_atomic_endpoints += checker.healthy_atomic_endpoints
-            healthy_ipfs_endpoints += checker.healthy_ipfs_endpoints
-            healthy_lightapi_endpoints += checker.healthy_lightapi_endpoints
-
-            producer_info = {
-                "account": producer["owner"],
-                "org_name": checker.org_name,
-                "bp_json_content": checker.bp_json,
-                "history": len(checker.healthy_history_endpoints),
-                "hyperion": len(checker.healthy_hyperion_endpoints),
-                "atomic": len(checker.healthy_atomic_endpoints),
-                "lightapi": len(checker.healthy_lightapi_endpoints),
-                "position": checker.producer_info["position"],
-                "status": checker.status,
-                "errors": checker.errors,
-                "oks": checker.oks,
-                "warnings": checker.warnings,
-                "endpoint_errors": checker.endpoint_errors,
-                "endpoint_oks": checker.endpoint_oks,
-                "endpoints": checker.endpoints,
-                # 'p2p_endpoints': checker.p2p_endpoints,
-                "bp_json": checker.producer_info["bp_json_url"],
-                "onchain_bp_json": checker.onchain_bp_json,
-            }
-            if isFIO:
-                producer_info["fio_address"] = producer["fio_address"]
-
-            producers_array.append(producer_info)
-
-        healthy_api_endpoints = list(set(healthy_api_endpoints))
-        healthy_p2p_endpoints = list(set(healthy_p2p_endpoints))
-        healthy_history_endpoints = list(set(healthy_history_endpoints))
-        healthy_atomic_endpoints = list(set(healthy_atomic_endpoints))
-        healthy_hyperion_endpoints = list(set(healthy_hyperion_endpoints))
-        healthy_ipfs_endpoints = list(set(healthy_ipfs_endpoints))
-        healthy_lightapi_endpoints = list(set(healthy_lightapi_endpoints))
-        random.shuffle(producers_array)
-        random.shuffle(healthy_api_endpoints)
-        random.shuffle(healthy_p2p_endpoints)
-        random.shuffle(healthy_history_endpoints)
-        random.shuffle(healthy_atomic_endpoints)
-        random.shuffle(healthy_hyperion_endpoints)
-        random.shuffle(healthy_ipfs_endpoints)
-        random.shuffle(healthy_lightapi_endpoints)
-
-        data = {
-            "producers": producers_array,
-            "last_update": datetime.datetime.utcnow().strftime("%d/%m/%y %H:%M:%S UTC"),
-            "last_update_iso": datetime.datetime.utcnow().isoformat(),
-            "healthy_api_endpoints": healthy_api_endpoints,
-            "healthy_p2p_endpoints": healthy_p2p_endpoints,
-            "healthy_history_endpoints": healthy_history_endpoints,
-            "healthy_hyperion_endpoints": healthy_hyperion_endpoints,
-            "healthy_atomic_endpoints": healthy_atomic_endpoints,
-            "healthy_ipfs_endpoints": healthy_ipfs_endpoints,
-            "healthy_lightapi_endpoints": healthy_lightapi_endpoints,
-        }
 
-        PUB_PATH = "{}/pub".format(SCRIPT_PATH)
-        CURRENT_DATE = datetime.datetime.today().strftime("%Y-%m-%d")
-        if not os.path.exists(PUB_PATH):
-            os.makedirs(PUB_PATH)
-        with open(
-            "{}/pub/{}.json".format(SCRIPT_PATH, chain_info["chain_id"]), "w"
-        ) as fp:
-            json.dump(data, fp, sort_keys=True, indent=4)
-        with open(
-            "{}/pub/{}-{}.json".format(
-                SCRIPT_PATH, chain_info["chain_id"], CURRENT_DATE
-            ),
-            "w",
-        ) as fp:
-            json.dump(data, fp, sort_keys=True, indent=4)
+def profiled(run, path):
+    """Run run() under the sampling profiler and write what it saw to path"""
+    sampler = Sampler()
+    sampler.start()
+    try:
+        run()
+    finally:
+        sampler.stop()
+        sampler.write(path)
+        logging.info(
+            "Profile of {} samples written to {}".format(sampler.samples, path)
+        )
+        for function, share in sampler.top():
+            logging.info("{:6.1%} {}".format(share, function))
 
 
 if __name__ == "__main__":
-    main()
+    if PROFILE:
+        profiled(main, PROFILE)
+    else:
+        main()